@@ -24,12 +24,20 @@ import numpy as np
 import numpy.random as rd
 import scipy.stats as st
 import scipy.special as sp
+import scipy.signal as sg
 import matplotlib.pyplot as plt
 
 # This ensured that the results will be the same from one run to the
 # next, even if they are 'random'.
 rd.seed(1729)
 
+# The values of P over which the posteriors of coins are calculated, which
+# are the same every time
+_coin_steps = 1000
+_coin_P_vector = np.linspace(0., 1., num = _coin_steps)
+# Likewise for the differences between two values of P
+_coin_delta_vector = np.linspace(-1, 1, num = 2 * _coin_steps - 1)
+
 
 def compare_catapults(mu_A, mu_B, sigma_A, sigma_B, n_throws, plotting = True, plot_folder = 'differences_plots', plot_main_name = 'Catapults'):
    """
@@ -117,7 +125,7 @@ def compare_catapults(mu_A, mu_B, sigma_A, sigma_B, n_throws, plotting = True, p
 
    mu_step_width = (max_mu - min_mu) / n_steps
    sigma_step_width = (max_sigma - min_sigma) / n_steps
-   delta_step_width = (max(delta_vector) - min(delta_vector)) / delta_steps
+   delta_step_width = (np.max(delta_vector) - np.min(delta_vector)) / delta_steps
 
    # To make the plots easy to compare, we will plot mu over the range of
    # the true mu:s plus-minus three times the biggest sigmas
@@ -151,7 +159,10 @@ def compare_catapults(mu_A, mu_B, sigma_A, sigma_B, n_throws, plotting = True, p
    p = {}
    for catapult in catapults:
       log_p[catapult] = log_prior[catapult] + log_L[catapult]
-      p[catapult] = np.exp(log_p[catapult])
+      # The posterior is normalised further down, so it can be rescaled
+      # freely. Subtracting the maximum before exponentiating keeps it from
+      # underflowing to zero everywhere when there are many throws.
+      p[catapult] = np.exp(log_p[catapult] - np.max(log_p[catapult]))
    if plotting:
       fig, axs = plt.subplots(1, len(catapults))
       for i in range(len(catapults)):
@@ -213,7 +224,7 @@ def compare_catapults(mu_A, mu_B, sigma_A, sigma_B, n_throws, plotting = True, p
          true_mu = mu[catapult]
       
          axs.flat[i].hist(throws[catapult], bins = n_bins, label = r'Observerat')
-         bin_width = (max(throws[catapult]) - min(throws[catapult])) / n_bins
+         bin_width = (np.max(throws[catapult]) - np.min(throws[catapult])) / n_bins
          axs.flat[i].plot(mu_vector, best_fit[catapult] * n_throws * bin_width, label = r'Förväntat')
          axs.flat[i].set_xlim(left = mu_plot_min, right = mu_plot_max)
          axs.flat[i].set_ylim(bottom = 0, top = histogram_y_max*1.1)
@@ -231,7 +242,9 @@ def compare_catapults(mu_A, mu_B, sigma_A, sigma_B, n_throws, plotting = True, p
    P_dge0 = {}
    max_delta_mu = -np.inf
    for catapult_pair in catapult_pairs:
-      unnormalised_delta_mu = np.convolve(p_mu[catapult_pair[0]], np.flip(p_mu[catapult_pair[1]]))
+      # With n_steps = 1000, convolving via FFT is much faster than doing
+      # it directly
+      unnormalised_delta_mu = sg.fftconvolve(p_mu[catapult_pair[0]], np.flip(p_mu[catapult_pair[1]]))
       delta_mu[catapult_pair] = unnormalised_delta_mu / np.sum(unnormalised_delta_mu * delta_step_width)
       
       max_delta_mu = max(max_delta_mu, np.max(delta_mu[catapult_pair]))
@@ -301,7 +314,26 @@ def catapult_long_run(mu_A, mu_B, sigma_A, sigma_B, n_throws, n_trials, plotting
       plt.savefig('./{}/{}_histogram.png'.format(plot_folder, plot_main_name))
       plt.close()
    return P_dge0
-   
+
+def logB(alpha, beta):
+   """
+   The logarithm of the normalisation factor to the binomial likelihood
+   """
+   return sp.betaln(alpha, beta)
+
+def _coin_log_L(heads, n_tosses):
+   """
+   The log-likelihood P(successes|P) for a coin that came up heads the
+   given number of times over n_tosses tosses, over _coin_P_vector. If
+   heads is an array, the result has one row per element of it.
+   """
+   heads = np.asarray(heads)[..., np.newaxis]
+   tails = n_tosses - heads
+   # xlogy and xlog1py treat 0 * log(0) as 0, so P = 0 and P = 1 come out
+   # right even when there are no heads or no tails
+   log_L = sp.xlogy(heads, _coin_P_vector) + sp.xlog1py(tails, - _coin_P_vector) - logB(heads + 1, tails + 1)
+   return log_L
+
 def compare_coins(P_A, P_B, n_tosses, verbose = True, plotting = True, plot_folder = 'differences_plots', plot_main_name = 'Coins'):
    """
    Say that we have two coins A and B, and we want to know which one is
@@ -316,12 +348,6 @@ def compare_coins(P_A, P_B, n_tosses, verbose = True, plotting = True, plot_fold
    probability distribution over the differences in P. This then gives us
    the probability of one coin being better than the other.
    """
-   def logB(alpha, beta):
-      """
-      The logarithm of the normalisation factor to the binomial likelihood
-      """
-      return sp.loggamma(alpha) + sp.loggamma(beta) - sp.loggamma(alpha + beta)
-
    if P_A > 1 or P_B > 1:
       print('Probabilities cannot be larger than one!')
       print('Values input were {} and {}'.format(P_A, P_B))
@@ -340,15 +366,14 @@ def compare_coins(P_A, P_B, n_tosses, verbose = True, plotting = True, plot_fold
    # Generate tosses for each coin
    heads = {}
    for coin in coins:
-      heads[coin] = np.sum(rd.uniform(0., 1., size = n_tosses) < P[coin])
+      heads[coin] = rd.binomial(n_tosses, P[coin])
       if verbose:
          print('Coin {} scored {} heads'.format(coin, heads[coin]))
       
-   # Make a vector of the possible values of P
-   n_steps = 1000
-   P_vector = np.linspace(0., 1., num = n_steps)
-   delta_steps = 2 * n_steps - 1
-   delta_vector = np.linspace(-1, 1, num=delta_steps)   
+   # The possible values of P
+   n_steps = _coin_steps
+   P_vector = _coin_P_vector
+   delta_vector = _coin_delta_vector
    
    # The log-prior P(P). To stay consistent with a frequentist analysis, we
    # use a flat prior.
@@ -359,17 +384,7 @@ def compare_coins(P_A, P_B, n_tosses, verbose = True, plotting = True, plot_fold
    # The log-likelihood P(successes|P)
    log_L = {}
    for coin in coins:
-      tails = n_tosses - heads[coin]
-      with np.errstate(all = 'ignore'):
-         log_L[coin] = heads[coin] * np.log(P_vector) + tails * np.log(1 - P_vector) - logB(heads[coin] + 1, tails + 1)
-         if heads[coin] > 0:
-            log_L[coin][0] = - np.inf
-         else:
-            log_L[coin][0] = - logB(heads[coin] + 1, tails + 1)
-         if tails > 0:
-            log_L[coin][-1] = - np.inf
-         else:
-            log_L[coin][-1] = - logB(heads[coin] + 1, tails + 1)
+      log_L[coin] = _coin_log_L(heads[coin], n_tosses)
 
    # The full posterior over P
    log_pP = {}
@@ -408,10 +423,17 @@ def compare_coins(P_A, P_B, n_tosses, verbose = True, plotting = True, plot_fold
    P_dge0 = {}
    max_delta_P = -np.inf
    for coin_pair in coin_pairs:
-      delta_P[coin_pair] = np.convolve(pP[coin_pair[0]], np.flip(pP[coin_pair[1]]))
-      P_dle0[coin_pair] = np.sum(delta_P[coin_pair][:n_steps]) / np.sum(delta_P[coin_pair])
-      P_dge0[coin_pair] = np.sum(delta_P[coin_pair][n_steps-1:]) / np.sum(delta_P[coin_pair])
-      max_delta_P = max(max_delta_P, np.max(delta_P[coin_pair]))
+      pP_first = pP[coin_pair[0]]
+      pP_second = pP[coin_pair[1]]
+      # Summing the difference distribution from Delta P = 0 upwards is the
+      # same as weighing each value of one posterior by the total of the
+      # other up to the same P, so the convolution is only needed for plots
+      total = np.sum(pP_first) * np.sum(pP_second)
+      P_dle0[coin_pair] = np.sum(pP_second * np.cumsum(pP_first)) / total
+      P_dge0[coin_pair] = np.sum(pP_first * np.cumsum(pP_second)) / total
+      if plotting:
+         delta_P[coin_pair] = sg.fftconvolve(pP_first, np.flip(pP_second))
+         max_delta_P = max(max_delta_P, np.max(delta_P[coin_pair]))
       if verbose:
          print('Probability that coin {} has higher P than coin {} is {:.2f}'.format(coin_pair[0], coin_pair[1], P_dge0[coin_pair]))
       
@@ -459,10 +481,15 @@ def coin_long_run(P_A, P_B, n_tosses, n_trials, plotting = True, plot_folder = '
    # having more bins than that creates an oddly spiked histogram.
    n_bins = min(int(np.floor(np.sqrt(n_trials))), n_tosses // 2)
 
-   P_dge0 = []
-   for i in range(n_trials):
-      P_dge0.append(compare_coins(P_A, P_B, n_tosses, plotting = False)[('A', 'B')])
-   P_dge0 = np.asarray(P_dge0)
+   # Rather than calling compare_coins once per trial, all trials are done
+   # at once, with one row per trial. This gives the same results as
+   # compare_coins, but not the same random numbers.
+   pP_A = np.exp(_coin_log_L(rd.binomial(n_tosses, P_A, size = n_trials), n_tosses))
+   pP_B = np.exp(_coin_log_L(rd.binomial(n_tosses, P_B, size = n_trials), n_tosses))
+   # Summing the convolution of pP_A and pP_B from Delta P = 0 upwards is
+   # the same as weighing each value of pP_A by the total of pP_B up to the
+   # same P, which saves doing the convolution
+   P_dge0 = np.sum(pP_A * np.cumsum(pP_B, axis = 1), axis = 1) / (np.sum(pP_A, axis = 1) * np.sum(pP_B, axis = 1))
    
    f_A_probably_better = np.sum(P_dge0 > 0.5) / n_trials
    
@@ -65,6 +65,15 @@ import matplotlib.pyplot as plt
 import imageio
 
 
+def _trapz_uniform(y, dx):
+   """
+   The trapezoid rule, for the case where all steps have the same length dx,
+   as they do in all the ranges used here. This avoids the temporary arrays
+   that np.trapz makes for the general case.
+   """
+   return dx * (np.sum(y) - 0.5 * (y[0] + y[-1]))
+
+
 class experiment:
    """
    This represents the experiment and the following fitting of a model to
@@ -148,12 +157,19 @@ class experiment:
 
    def _calculate_CDF(self, parameter_range, PDF):
       """
-      This is *not* computationally efficient
+      Integrates the PDF from the start of the range with the trapezoid rule,
+      using a cumulative sum rather than integrating anew for each point.
       """
       n_points = len(parameter_range)
       CDF = np.zeros(n_points)
-      for i in range(n_points-1):
-         CDF[i+1] = np.trapz(PDF[0:i], x=parameter_range[0:i])
+      # With fewer than two points there is no step, and nothing to integrate
+      if n_points < 2:
+         return CDF
+      dx = parameter_range[1] - parameter_range[0]
+      # CDF[i+1] is the integral over the first i points, which is zero for
+      # fewer than two points
+      i = np.arange(1, n_points - 1)
+      CDF[i+1] = dx * (np.cumsum(PDF)[i-1] - 0.5 * (PDF[0] + PDF[i-1]))
       return CDF
       
 
@@ -204,7 +220,7 @@ class experiment:
             x = self.measurements[j,0]
             y = self.measurements[j,1]
             integrand = self.P_scatter_given_true(x_true_range, y_true_range, x, y)
-            P = np.trapz(integrand, x=self.r_range)
+            P = _trapz_uniform(integrand, self.r_range[1] - self.r_range[0])
             self.likelihood['alpha'][i] *= P
       return
       
@@ -221,7 +237,7 @@ class experiment:
             y = self.measurements[j,1]
             P_xy_a = self.P_scatter_given_true(x_true_range, y_true_range, x, y)
             P_x = np.sqrt(1. + a**2)
-            P = np.trapz(P_xy_a * P_x, x=x_true_range)
+            P = _trapz_uniform(P_xy_a * P_x, x_true_range[1] - x_true_range[0])
             self.likelihood['a'][i] *= P
       return
 
@@ -231,7 +247,7 @@ class experiment:
          self.posterior_CDF[parameter] = {}
          for prior_name, prior_vector in self.prior[parameter].items():
             unnormalised_posterior = self.likelihood[parameter] * prior_vector
-            self.posterior[parameter]['{} prior'.format(prior_name)] = unnormalised_posterior / np.trapz(unnormalised_posterior, x=self.parameter_range[parameter])
+            self.posterior[parameter]['{} prior'.format(prior_name)] = unnormalised_posterior / _trapz_uniform(unnormalised_posterior, self.parameter_range[parameter][1] - self.parameter_range[parameter][0])
             self.posterior_CDF[parameter]['{} prior'.format(prior_name)] = self._calculate_CDF(self.parameter_range[parameter], self.posterior[parameter]['{} prior'.format(prior_name)])
       return
 
@@ -47,15 +47,127 @@ https://github.com/Alvin-Gavel/Demodigi
 import selenium as sl
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.common.by import By
-from selenium.common.exceptions import NoSuchElementException
-
-import numpy as np
-import csv
-from datetime import datetime
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import WebDriverException, NoSuchElementException, ElementNotInteractableException, StaleElementReferenceException, TimeoutException
+
+import pandas as pd
+import requests
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from datetime import datetime, timedelta
 from time import sleep
 
+# How long, in seconds, to wait for an element to show up before giving
+# up, and how often to look for it in the meantime
+_wait_timeout = 20
+_poll_frequency = 0.25
+# How many times to look an element up again, if SharePoint redraws it
+# between us finding it and clicking on it
+_stale_retries = 3
+
+# How many addresses to enter in the share dialog at a time, when adding
+# many participants as members at once
+_share_batch_size = 50
+
+# Things that the browser need not bother downloading, since the robot
+# never looks at them
+_blocked_urls = ["*.png", "*.jpg", "*.gif", "*.svg", "*.woff", "*.woff2", "*analytics*"]
+
+# The columns of the shared list of usernames and passwords, as (internal
+# name, display name, description). The internal names are kept free of
+# umlauts, since SharePoint otherwise mangles them
+_id_pwd_columns = [('Anvandarnamn', 'Användarnamn', 'Användarnamn till Canvas-kontot'),
+                   ('Losenord', 'Lösenord', 'Lösenord till Canvas-kontot')]
+
+# Locators for elements that we look for more than once. Those given as
+# bare strings are XPath expressions, to be passed to fill_fields
+_settings_menu = (By.CSS_SELECTOR, "[aria-label='Open the Settings menu to access personal and app settings']")
+_add_column = (By.XPATH, "//*[text()='Add column']")
+_save_column = "//*[contains(@class, 'ms-ColumnManagementPanel-saveButton')]"
+_new_item = (By.XPATH, "//*[text()='New']")
+_save = (By.XPATH, "//*[text()='Save']")
+_remove_permissions = (By.ID, "Ribbon.Permission.Modify.RemovePerms-Large")
+_name_field = "//*[text()='Name']/following::input[@type='text']"
+_description_field = "//*[text()='Description']/following::textarea"
+_item_fields = ["//*[text()='Title']/following::input[@type='text'][position()={}]".format(i) for i in (1, 2, 3)]
+
+# Sequences of steps for things that we do the same way every time, to be
+# carried out by _run_steps. Each step is either ('click', locator),
+# ('wait', locator), ('fill', [(XPath expression, key), ...]) or
+# ('fill and click', ([(XPath expression, key), ...], XPath expression)), where
+# the keys are looked up among the texts given to _run_steps. The last kind
+# fills in a form and clicks a button in the same script
+_create_list_steps = [('click', (By.NAME, "New")),
+                      ('click', (By.NAME, "List")),
+                      ('fill and click', ([(_name_field, 'name'), (_description_field, 'description')], "//*[@aria-label='Create']")),
+                      # Once the list exists, we land on a page where we can
+                      # add columns
+                      ('wait', _add_column)]
+
+def _add_column_steps(column_type):
+   return [('click', _add_column),
+           ('click', (By.XPATH, "//*[text()='{}']".format(column_type))),
+           ('fill and click', ([(_name_field, 'name'), (_description_field, 'description')], _save_column))]
+
+_add_single_line_column_steps = _add_column_steps('Single line of text')
+_add_multiple_lines_column_steps = _add_column_steps('Multiple lines of text')
+
+# Fills in several text fields in a single round trip to the driver. The
+# fields are given as XPath expressions. SharePoint is built in React,
+# which keeps track of the contents of its input fields on its own and
+# ignores a plain assignment to .value, so we go through the setter of the
+# prototype and then tell it that the text has changed.
+_fill_fields_script = """
+var expressions = arguments[0];
+var texts = arguments[1];
+for (var i = 0; i < expressions.length; i++) {
+   var field = document.evaluate(expressions[i], document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+   var prototype = field.tagName == 'TEXTAREA' ? HTMLTextAreaElement.prototype : HTMLInputElement.prototype;
+   Object.getOwnPropertyDescriptor(prototype, 'value').set.call(field, texts[i]);
+   field.dispatchEvent(new Event('input', {bubbles: true}));
+   field.dispatchEvent(new Event('change', {bubbles: true}));
+}
+if (arguments[2]) {
+   document.evaluate(arguments[2], document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue.click();
+}
+"""
+
+
+def _list_path(title):
+   """
+   Path in the REST API to the list with the given title. Single quotes are
+   escaped by doubling them, as is the custom in OData.
+   """
+   return "web/lists/getbytitle('{}')".format(title.replace("'", "''"))
+
+
+def _id_pwd_fields(participant):
+   """
+   The values of a list item holding the username and password of a
+   participant, by internal column name, for the REST API.
+   """
+   fields = {'Title': participant.name}
+   for (internal_name, display_name, description), value in zip(_id_pwd_columns, [participant.username, participant.password]):
+      fields[internal_name] = value
+   return fields
+
+
+@lru_cache(maxsize = 256)
+def _clickable(by, expression):
+   """
+   The condition that an element can be clicked on. These do not hold any
+   state of their own, so we make one per locator and reuse it rather than
+   making a new one every time we wait for something.
+   """
+   return EC.element_to_be_clickable((by, expression))
+
 
 class participant():
+   # There may be ten thousand of these, so they do without a __dict__
+   __slots__ = ('name', 'code')
+
    def __init__(self, name, code):
       self.name = name
       self.code = code
@@ -79,6 +191,8 @@ class participant_info(participant):
    password : str
    \tPassword to Canvas account
    """
+   __slots__ = ('username', 'password')
+
    def __init__(self, name, code, username, password):
       participant.__init__(self, name, code)
       self.username = username
@@ -102,6 +216,8 @@ class participant_feedback(participant):
    \tmost likely instead have a list of flags for which of a number of text
    \ttemplates to use.
    """
+   __slots__ = ('feedback_text',)
+
    def __init__(self, name, code, feedback_text):
       participant.__init__(self, name, code)
       self.feedback_text = feedback_text
@@ -117,25 +233,102 @@ class clicker:
    ----------
    connection : SharepointConnection
    \tThe connection used to communicate with the SharePoint page
+   connections : list of SharepointConnection
+   \tOne connection per worker, starting with the one above. Each has a
+   \tbrowser of its own, since a WebDriver cannot be shared between threads.
    participants : list of participant
    \tThe participants that Canvas account information should be delivered to
    real_data : bool
    \tWhether the data represents actual people or simulated participants
    """
 
-   def __init__(self, connection):
+   def __init__(self, connection, n_workers = 1):
       self.connection = connection
+      self.connections = [connection] + [connection.fresh_copy() for i in range(n_workers - 1)]
       self.participants = []
       self.real_data = False
       return
 
+   def _member_batches(self):
+      """
+      Split the participants into batches that each fit in one go through
+      the share dialog. With simulated participants everyone is added under
+      the same address, so there is at most the one batch.
+      """
+      if not self.participants:
+         return []
+      if not self.real_data:
+         return [self.participants[:1]]
+      return [self.participants[start:start + _share_batch_size] for start in range(0, len(self.participants), _share_batch_size)]
+
+   def _for_each_participant(self, work, before = None, add_members = False):
+      """
+      Start the drivers, do some work for each participant and then stop the
+      drivers again. If before is given, it is called with the first
+      connection once the drivers are running and before any other work. If
+      add_members is True, the participants are first added as members of
+      the site, with the batches of members shared out between the workers
+      in the same way as the participants.
+      
+      The participants are shared out between the workers, each of which
+      keeps the same browser throughout, unless it dies along the way, in
+      which case it is restarted and the work for that participant is done
+      over. The results are returned in the same order as the participants.
+      
+      If the work goes wrong for any participant, the work that has not yet
+      started is called off and all the drivers are stopped before the
+      exception is passed on.
+      """
+      idle_connections = queue.Queue()
+      
+      def work_on(work, item, description):
+         connection = idle_connections.get()
+         try:
+            try:
+               return work(connection, item)
+            except WebDriverException:
+               if connection.driver_is_alive():
+                  raise
+               print('Lost the browser while working on {}, restarting it'.format(description))
+               connection.restart_driver()
+               return work(connection, item)
+         finally:
+            idle_connections.put(connection)
+      
+      def share_out(work, items, describe, noun):
+         futures = [executor.submit(work_on, work, item, describe(item)) for item in items]
+         for n_done, future in enumerate(as_completed(futures), start = 1):
+            # Raises right away if the work went wrong
+            future.result()
+            print('Done with {} of {} {}'.format(n_done, len(futures), noun))
+         return [future.result() for future in futures]
+      
+      executor = ThreadPoolExecutor(max_workers = len(self.connections))
+      try:
+         for connection in self.connections:
+            connection.start_driver()
+            # Get through the login once for each browser now, rather than
+            # as part of the work on whichever participant comes first
+            connection.go_to_start()
+            idle_connections.put(connection)
+         if before is not None:
+            before(self.connection)
+         if add_members:
+            share_out(lambda connection, batch: connection.add_participants_as_members(batch, self.real_data), self._member_batches(), lambda batch: 'a batch of {} members'.format(len(batch)), 'batches of members')
+         results = share_out(work, self.participants, lambda participant: participant.name, 'participants')
+      finally:
+         executor.shutdown(cancel_futures = True)
+         for connection in self.connections:
+            connection.stop_driver()
+      return results
+
 
 class password_clicker(clicker):
    """
    A device for writing passwords to a SharePoint page
    """
-   def __init__(self, connection):
-      clicker.__init__(self, connection)
+   def __init__(self, connection, n_workers = 1):
+      clicker.__init__(self, connection, n_workers = n_workers)
       return
    
    def read_participant_list(self, path):
@@ -143,18 +336,13 @@ class password_clicker(clicker):
       Reads a csv-file of participants, in the format
       name, code, username, password
       """
-      f = open(path, 'r', newline='', encoding='utf-8')
-      reader = csv.reader(f, delimiter = ',')
-      # Skip header
-      next(reader)
-      self.participants = []
-      for line in reader:
-         name = line[0].strip()
-         code = line[1].strip()
-         username = line[2].strip()
-         password = line[3].strip()
-         self.participants.append(participant_info(name, code, username, password))
-      f.close()
+      # The participants are gone through more than once, and in order, so
+      # they are all held in memory anyway and the file is read in one go.
+      # Read in large chunks, in case the file sits on a slow network drive
+      with open(path, 'r', newline = '', encoding = 'utf-8', buffering = 1 << 20) as f:
+         participants = pd.read_csv(f, usecols = [0, 1, 2, 3], dtype = str, keep_default_na = False, skipinitialspace = True)
+      participants = participants.apply(lambda column: column.str.strip())
+      self.participants = [participant_info(*line) for line in participants.itertuples(index = False, name = None)]
       
       self.real_data = True
       return
@@ -163,9 +351,7 @@ class password_clicker(clicker):
       """
       Generate a list of pretended particpants
       """
-      self.participants = []
-      for i in range(n_participants):
-         self.participants.append(participant_info('Robot {}'.format(i), 'rbt{}'.format(i), 'usr{}'.format(i), '123456'))
+      self.participants = [participant_info('Robot {}'.format(i), 'rbt{}'.format(i), 'usr{}'.format(i), '123456') for i in range(n_participants)]
       self.real_data = False
       return
    
@@ -175,27 +361,35 @@ class password_clicker(clicker):
       for each participant, and makes that information available to that
       participant and noone else.
       """
-      self.connection.start_driver()
-      for participant in self.participants:
-         self.connection.make_id_pwd_list(participant, self.real_data)
-      self.connection.stop_driver()
+      # Through the REST API, read access to the list is all they need
+      add_members = self.connection.site_path is None
+      self._for_each_participant(lambda connection, participant: connection.make_id_pwd_list(participant, self.real_data, add_as_member = False), add_members = add_members)
+      return
+
+   def construct_shared_sharepoint_list(self, title = 'Canvas-konton'):
+      """
+      Construct a single list on SharePoint with one item per participant,
+      containing their username and password, where each item is available
+      to that participant and noone else. This needs the connection to have
+      a site_path, since it is done through the REST API.
+      """
+      if self.connection.site_path is None:
+         print('Cannot make a shared list without knowing the site path!')
+         return
+      self._for_each_participant(lambda connection, participant: connection.add_id_pwd_item(title, participant, self.real_data), before = lambda connection: connection.create_shared_id_pwd_list(title))
       return
       
    def verify_sharepoint_lists(self):
       """
       Verify that participants have correctly been written to SharePoint
       """
-      self.connection.start_driver()
-      correct = []
-      for participant in self.participants:
-         correct.append(self.connection.check_id_pwd_list(participant))
-      self.connection.stop_driver()
-      if sum(correct) == 0:
+      correct = self._for_each_participant(lambda connection, participant: connection.check_id_pwd_list(participant))
+      if all(correct):
+         print('All participants seem to have correct lists')
+      else:
          for participant, correctness in zip(self.participants, correct):
             if not correctness:
                print('Problems with list for {}'.format(participant.name))
-      else:
-         print('All participants seem to have correct lists')
       return
 
 
@@ -203,17 +397,15 @@ class feedback_clicker(clicker):
    """
    A device for writing feedback to a SharePoint page
    """
-   def __init__(self, connection):
-      clicker.__init__(self, connection)
+   def __init__(self, connection, n_workers = 1):
+      clicker.__init__(self, connection, n_workers = n_workers)
       return
 
    def simulate_participant_list(self, n_participants):
       """
       Generate a list of pretended particpants
       """
-      self.participants = []
-      for i in range(n_participants):
-         self.participants.append(participant_feedback('Robot {}'.format(i), 'rob{}@skynet.com'.format(i), 'Bra jobbat!'))
+      self.participants = [participant_feedback('Robot {}'.format(i), 'rob{}@skynet.com'.format(i), 'Bra jobbat!') for i in range(n_participants)]
       self.real_data = False
       return
 
@@ -222,10 +414,7 @@ class feedback_clicker(clicker):
       Construct pages on SharePoint which contain feedback for each
       participant.
       """
-      self.connection.start_driver()
-      for participant in self.participants:
-         self.connection.deliver_feedback(participant, self.real_data)
-      self.connection.stop_driver()
+      self._for_each_participant(lambda connection, participant: connection.deliver_feedback(participant, self.real_data, add_as_member = False), add_members = True)
       return
       
 class SharePointConnection(object):
@@ -243,14 +432,36 @@ class SharePointConnection(object):
    \tThe browser to be used. So far the only choice sure to work is Chrome
    driver_directory_path : str
    \tPath to the directory where the drivers are kept
+   site_path : str or None
+   \tWeb address of the SharePoint site that the page belongs to, for
+   \texample https://something.sharepoint.com/sites/Something. If given,
+   \tlists are checked through the REST API of SharePoint rather than by
+   \tclicking around in the browser.
+   headless : bool
+   \tWhether to run Chrome without a window. This is faster, but means
+   \tthat you cannot see what the robot is doing when something goes wrong.
+   verbose : bool
+   \tWhether to print the time at which work on each participant begins
+   \tand ends
    """
-   def __init__(self, start_page_path, start_page_name, browser, driver_directory_path):
+   def __init__(self, start_page_path, start_page_name, browser, driver_directory_path, site_path = None, headless = False, verbose = True):
       self.start_page_path = start_page_path
       self.start_page_name = start_page_name
       self.browser = browser
       self.driver_directory_path = driver_directory_path
       self.session_start_time = datetime.now()
+      self.site_path = site_path
+      self.headless = headless
+      self.verbose = verbose
       self.driver = None
+      self.wait = None
+      self.session = None
+      self.form_digest = None
+      self.form_digest_expiry = None
+      self.reader_role_id = None
+      # These depend on the name of the page, but not on the participant
+      self._visitors = (By.CSS_SELECTOR, "[title='Besökare på {}']".format(start_page_name))
+      self._members = (By.CSS_SELECTOR, "[title='Medlemmar på {}']".format(start_page_name))
       return
       
    def start_driver(self):
@@ -259,72 +470,246 @@ class SharePointConnection(object):
          chrome_options = sl.webdriver.chrome.options.Options()
          chrome_options.add_argument("--disable-extensions")
          chrome_options.add_argument("--start-maximized")        
+         # Images are never looked at, so there is no point in loading them
+         chrome_options.add_argument("--blink-settings=imagesEnabled=false")
+         if self.headless:
+            chrome_options.add_argument("--headless=new")
+            chrome_options.add_argument("--disable-gpu")
+            # Without a window there is nothing to maximise, and SharePoint
+            # hides some buttons when the page is narrow
+            chrome_options.add_argument("--window-size=1920,1080")
+            # /dev/shm is small on many Linux machines, which causes crashes
+            # when several browsers run at once
+            chrome_options.add_argument("--disable-dev-shm-usage")
          self.driver = sl.webdriver.Chrome(chrome_options = chrome_options, executable_path = self.driver_directory_path + '/chromedriver')
+         # Neither are fonts, icons or tracking scripts
+         self.driver.execute_cdp_cmd("Network.enable", {})
+         self.driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": _blocked_urls})
       elif self.browser == 'Firefox':
          firefox_options = sl.webdriver.firefox.options.Options()
          self.driver = sl.webdriver.Firefox(executable_path = self.driver_directory_path + '/geckodriver')
       else:
          print('Cannot find browser option!')
          self.driver = None
+      if self.driver is not None:
+         # Rather than sleeping for a fixed time before every step, we poll
+         # until whatever we want to click on is actually there
+         self.wait = WebDriverWait(self.driver, timeout = _wait_timeout, poll_frequency = _poll_frequency, ignored_exceptions = [NoSuchElementException, ElementNotInteractableException, StaleElementReferenceException])
       print('Started driver!')
       self.session_start_time = datetime.now()
       return
 
+   def _report(self, event):
+      if self.verbose:
+         print('{} work at {}'.format(event, datetime.now().strftime('%X')))
+      return
+
    def stop_driver(self):
-      self.driver.quit()
+      """
+      Quit the browser, if there is one. A browser that has already died is
+      simply let go.
+      """
+      if self.driver is not None:
+         try:
+            self.driver.quit()
+         except WebDriverException:
+            pass
+         self.driver = None
+      return
+
+   def fresh_copy(self):
+      """
+      Make a new connection with the same settings as this one, but with no
+      browser, session or form digest of its own.
+      """
+      return type(self)(self.start_page_path, self.start_page_name, browser = self.browser, driver_directory_path = self.driver_directory_path, site_path = self.site_path, headless = self.headless, verbose = self.verbose)
+
+   def driver_is_alive(self):
+      """
+      Check whether the browser is still there to talk to.
+      """
+      try:
+         self.driver.current_url
+         return True
+      except WebDriverException:
+         return False
+
+   def restart_driver(self):
+      """
+      Replace a browser that has died with a fresh one.
+      """
+      self.stop_driver()
+      self.start_driver()
+      return
+
+   def grant_sole_read_access(self, path, participant, real_data):
+      """
+      Through the REST API, make whatever is at the given path - a list or
+      an item in one - stop inheriting permissions from the site and give the
+      participant, and noone else, the right to read it.
+      """
+      if not real_data:
+         address = 'alvin.gavel@arbetsförmedlingen.se'
+      else:
+         address = participant.code
+      self.rest('POST', '{}/breakroleinheritance(copyRoleAssignments=false,clearSubscopes=true)'.format(path))
+      user = self.rest('POST', 'web/ensureuser', {'logonName': address})
+      if self.reader_role_id is None:
+         self.reader_role_id = self.rest('GET', 'web/roledefinitions/getbytype(2)')['Id']
+      self.rest('POST', '{}/roleassignments/addroleassignment(principalid={},roledefid={})'.format(path, user['Id'], self.reader_role_id))
+      return
+
+   def start_session(self):
+      """
+      Set up an HTTP session for the REST API, logged in with the cookies of
+      the browser. We have to have visited the SharePoint page first, or
+      there are no cookies to borrow.
+      """
+      self.session = requests.Session()
+      for cookie in self.driver.get_cookies():
+         self.session.cookies.set(cookie['name'], cookie['value'], domain = cookie['domain'])
       return
 
+   def rest(self, method, path, json = None):
+      """
+      Make a call to the REST API of SharePoint, with a path relative to
+      _api/ on the site, and return whatever comes back as JSON. Raises
+      requests.HTTPError if SharePoint says no.
+      """
+      if self.session is None:
+         self.go_to_start()
+         self.start_session()
+      headers = {'Accept': 'application/json;odata=nometadata'}
+      if method == 'POST':
+         headers['Content-Type'] = 'application/json;odata=nometadata'
+         headers['X-RequestDigest'] = self._get_form_digest()
+      response = self.session.request(method, '{}/_api/{}'.format(self.site_path, path), headers = headers, json = json, timeout = _wait_timeout)
+      response.raise_for_status()
+      if not response.content:
+         return None
+      return response.json()
+
+   def _get_form_digest(self):
+      """
+      Anything that changes SharePoint has to come with a form digest, which
+      runs out after a while, so we get a new one when needed.
+      """
+      if self.form_digest is None or datetime.now() > self.form_digest_expiry:
+         response = self.session.post('{}/_api/contextinfo'.format(self.site_path), headers = {'Accept': 'application/json;odata=nometadata'}, timeout = _wait_timeout)
+         response.raise_for_status()
+         info = response.json()
+         self.form_digest = info['FormDigestValue']
+         # Leave a minute's margin
+         self.form_digest_expiry = datetime.now() + timedelta(seconds = info['FormDigestTimeoutSeconds'] - 60)
+      return self.form_digest
+
    def go_to_page(self, adress):
       self.driver.get(adress)
       return
       
    def go_to_start(self):
-      self.go_to_page(self.start_page_path)
+      """
+      Go to the start page, unless we are already there. SharePoint may
+      redirect or add a query string, so only the address up to any query
+      string has to match.
+      """
+      start_page = self.start_page_path.split('?')[0]
+      if start_page not in self.driver.current_url:
+         self.go_to_page(self.start_page_path)
+         self.wait.until(EC.url_contains(start_page))
+      return
+
+   def wait_for(self, by, expression):
+      """
+      Wait until an element can be clicked on, and return it.
+      """
+      return self.wait.until(_clickable(by, expression))
+
+   def click(self, by, expression):
+      """
+      Wait until an element can be clicked on, click it and return it. While
+      waiting, stale elements are simply ignored, but SharePoint may also
+      redraw the element after we found it, in which case we look it up anew.
+      """
+      for attempt in range(_stale_retries):
+         try:
+            element = self.wait_for(by, expression)
+            element.click()
+            return element
+         except StaleElementReferenceException:
+            if attempt == _stale_retries - 1:
+               raise
+
+   def accept_alert(self):
+      """
+      Wait for an alert to pop up, and accept it.
+      """
+      self.wait.until(EC.alert_is_present()).accept()
+      return
+
+   def fill_fields(self, expressions, texts, then_click = None):
+      """
+      Write texts into several text fields, given as XPath expressions, in
+      one go rather than one send_keys per field. We only wait for the last
+      of the fields, on the assumption that the ones before it have shown up
+      by then. If then_click is given, the button that it gives the XPath
+      expression of is clicked in the same go.
+      """
+      self.wait_for(By.XPATH, expressions[-1])
+      self.driver.execute_script(_fill_fields_script, expressions, texts, then_click)
       return
 
    def add_participant_as_member(self, participant, real_data):
-      settings_menu = self.driver.find_element(By.CSS_SELECTOR, "[aria-label='Open the Settings menu to access personal and app settings']")
-      settings_menu.click()
-      sleep(2)
-      settings_button = self.driver.find_element(By.CSS_SELECTOR, "[aria-label='Site permissions']")
-      settings_button.click()
-      sleep(5)
-      share_button = self.driver.find_element(By.XPATH, "//*[text()='Share site']")
-      share_button.click()
-      sleep(2)
-      add_field = self.driver.find_element(By.CSS_SELECTOR, "[aria-label='Add members to the site']")
-      add_field.click()
+      self.add_participants_as_members([participant], real_data)
+      return
+
+   def add_participants_as_members(self, participants, real_data):
+      """
+      Add several participants as members of the site, entering a whole
+      batch of addresses in the share dialog before clicking Add, rather than
+      going through the dialog once per participant.
+      """
       if not real_data:
-         address = 'alvin.gavel@arbetsförmedlingen.se'
+         addresses = ['alvin.gavel@arbetsförmedlingen.se']
       else:
-         address = participant.code
-      add_field.send_keys(address)
-      sleep(2)
-      add_field.send_keys(Keys.RETURN)
-      sleep(2)
-      add_button = self.driver.find_element(By.XPATH, "//*[text()='Add']")
-      add_button.click()
-      sleep(2)
+         addresses = [participant.code for participant in participants]
+      for start in range(0, len(addresses), _share_batch_size):
+         self.go_to_start()
+         self.click(*_settings_menu)
+         self.click(By.CSS_SELECTOR, "[aria-label='Site permissions']")
+         self.click(By.XPATH, "//*[text()='Share site']")
+         add_field = self.click(By.CSS_SELECTOR, "[aria-label='Add members to the site']")
+         for address in addresses[start:start + _share_batch_size]:
+            add_field.send_keys(address)
+            # There is nothing in particular to wait for while SharePoint
+            # looks up the address, so here we still have to sleep
+            sleep(2)
+            add_field.send_keys(Keys.RETURN)
+         self.click(By.XPATH, "//*[text()='Add']")
       return
       
+   def _run_steps(self, steps, texts = None):
+      """
+      Carry out a sequence of steps, as described above _create_list_steps,
+      filling in fields with the texts given by key.
+      """
+      if texts is None:
+         texts = {}
+      for action, argument in steps:
+         if action == 'click':
+            self.click(*argument)
+         elif action == 'wait':
+            self.wait_for(*argument)
+         elif action == 'fill':
+            self.fill_fields([expression for expression, key in argument], [texts[key] for expression, key in argument])
+         elif action == 'fill and click':
+            fields, selector = argument
+            self.fill_fields([expression for expression, key in fields], [texts[key] for expression, key in fields], then_click = selector)
+      return
+
    def create_list(self, description, participant):
       self.go_to_start()
-      sleep(20)
-      new_button = self.driver.find_element(By.NAME, "New")
-      new_button.click()
-      sleep(2)
-      list_choice = self.driver.find_element(By.NAME, "List")
-      list_choice.click()
-      sleep(2)
-      name_field = self.driver.find_element(By.XPATH, "//*[text()='Name']/following::input[@type='text']")
-      name_field.send_keys("{}".format(participant.name))
-      sleep(2)
-      desc_field = self.driver.find_element(By.XPATH, "//*[text()='Description']/following::textarea")
-      desc_field.send_keys(description)
-      sleep(2)
-      create_button = self.driver.find_element(By.CSS_SELECTOR, "[aria-label=Create]")
-      create_button.click()
-      sleep(20)
+      self._run_steps(_create_list_steps, {'name': participant.name, 'description': description})
       return
       
    def set_read_privileges(self, participant, real_data):
@@ -334,131 +719,74 @@ class SharePointConnection(object):
       lists. Hence, we implement feedback as a list even though this is not
       the most obvious choice of format.
       """
-      settings_menu = self.driver.find_element(By.CSS_SELECTOR, "[aria-label='Open the Settings menu to access personal and app settings']")
-      settings_menu.click()
-      sleep(2)
-      settings_button = self.driver.find_element(By.CSS_SELECTOR, "[aria-label='List settings']")
-      settings_button.click()
-      sleep(5)
-      permissions_link = self.driver.find_element(By.XPATH, "//*[text()='Permissions for this list']")
-      permissions_link.click()
-      sleep(5)
-      stopinherit_button = self.driver.find_element(By.ID, "Ribbon.Permission.Manage.StopInherit-Large")
-      stopinherit_button.click()
-      sleep(2)
-      self.driver.switch_to.alert.accept()
-      sleep(2)
-      visitor_checkbox = self.driver.find_element(By.XPATH, "//*[@title='Besökare på {}']".format(self.start_page_name))
-      visitor_checkbox.click()
-      removeperm_button = self.driver.find_element(By.ID, "Ribbon.Permission.Modify.RemovePerms-Large")
-      removeperm_button.click()
-      self.driver.switch_to.alert.accept()
-      sleep(5)
-      member_checkbox = self.driver.find_element(By.XPATH, "//*[@title='Medlemmar på {}']".format(self.start_page_name))
-      member_checkbox.click()
-      removeperm_button = self.driver.find_element(By.ID, "Ribbon.Permission.Modify.RemovePerms-Large")
-      removeperm_button.click()
-      self.driver.switch_to.alert.accept()
-      sleep(5)
-      giveperm_button = self.driver.find_element(By.ID, "Ribbon.Permission.Add.AddUser-Large")
-      giveperm_button.click()
-      sleep(2)      
-      name_field = self.driver.find_element(By.XPATH, "//*[text()='Enter names or email addresses...']/following::input[@type='text']")
+      self.click(*_settings_menu)
+      self.click(By.CSS_SELECTOR, "[aria-label='List settings']")
+      self.click(By.XPATH, "//*[text()='Permissions for this list']")
+      self.click(By.ID, "Ribbon.Permission.Manage.StopInherit-Large")
+      self.accept_alert()
+      self.click(*self._visitors)
+      self.click(*_remove_permissions)
+      self.accept_alert()
+      self.click(*self._members)
+      self.click(*_remove_permissions)
+      self.accept_alert()
+      self.click(By.ID, "Ribbon.Permission.Add.AddUser-Large")
+      name_field = self.wait_for(By.XPATH, "//*[text()='Enter names or email addresses...']/following::input[@type='text']")
       if not real_data:
          address = 'alvin.gavel@arbetsförmedlingen.se'
       else:
          address = participant.code
       name_field.send_keys(address)
       name_field.send_keys(Keys.RETURN)
-      sleep(2)
       #invite_field = self.driver.find_element(By.ID, "TxtEmailBody")  
       #if not real_data:
       #   invite_field.send_keys("Om detta inte varit ett simulerat test så skulle en text ha skrivits här och skickats till mailadressen {}. Nu skickas den till dig, för att bekräfta att mailandet fungerar.".format(participant.email))
       #else:
       #   invite_field.send_keys("Hej! Detta är ett test utfört av Alvin inom Demokratisk Digitalisering, för att testa om det går att överföra Canvas-användarnamn och lösenord via en SharePoint-sida, där varje deltagare får se en lista som innehåller deras eget användarnamn och lösenord. Nedan finns en länk till en sida som heter '{}' som innehåller ditt användarnamn och lösenord.".format(participant.name))
-      #sleep(2)
-      options_button = self.driver.find_element(By.ID, "Share_ShowHideMoreOptions")
-      options_button.click()
-      sleep(2)
-      sendmail_button = self.driver.find_element(By.ID, "chkSendEmailv15")
-      sendmail_button.click()
-      sleep(2)
-      options_list = self.driver.find_element(By.ID, "DdlGroup")
-      options_list.click()
-      sleep(2)
-      read_choice = self.driver.find_element(By.XPATH, "//*[text()='Read']")
-      read_choice.click()
-      sleep(2)
-      share_button = self.driver.find_element(By.ID, "btnShare")
-      share_button.click()
-      sleep(2)
+      self.click(By.ID, "Share_ShowHideMoreOptions")
+      self.click(By.ID, "chkSendEmailv15")
+      self.click(By.ID, "DdlGroup")
+      self.click(By.XPATH, "//*[text()='Read']")
+      self.click(By.ID, "btnShare")
+      return
 
 class feedback_connection(SharePointConnection):
    """
    Used for writing passwords to SharePoint
    """
-   def __init__(self, start_page_path, start_page_name, browser = 'Chrome', driver_directory_path = './Drivers'):
-      SharePointConnection.__init__(self, start_page_path, start_page_name, browser = browser, driver_directory_path = driver_directory_path)
+   def __init__(self, start_page_path, start_page_name, browser = 'Chrome', driver_directory_path = './Drivers', site_path = None, headless = False, verbose = True):
+      SharePointConnection.__init__(self, start_page_path, start_page_name, browser = browser, driver_directory_path = driver_directory_path, site_path = site_path, headless = headless, verbose = verbose)
       return
 
-   def deliver_feedback(self, participant, real_data):
+   def deliver_feedback(self, participant, real_data, add_as_member = True):
       """
       This should make a page giving feedback to the participant, based on
-      their results.
+      their results. If they have already been made a member of the site, set
+      add_as_member to False.
       """
-      print('Began work at {}'.format(datetime.now().strftime('%X')))
-      self.go_to_start()
-      self.add_participant_as_member(participant, real_data)
+      self._report('Began')
+      if add_as_member:
+         self.add_participant_as_member(participant, real_data)
 
       # Create a new page
-      self.go_to_start()
-      sleep(20)
       self.create_list("Feedback till {}".format(participant.name), participant)
       
       # Write feedback
-      column_button = self.driver.find_element(By.XPATH, "//*[text()='Add column']")
-      column_button.click()
-      sleep(2)
-      multiple_line_choice = self.driver.find_element(By.XPATH, "//*[text()='Multiple lines of text']")
-      multiple_line_choice.click()
-      sleep(2)
-      name_field = self.driver.find_element(By.XPATH, "//*[text()='Name']/following::input[@type='text']")
-      name_field.send_keys("Feedback")
-      sleep(2)
-      desc_field = self.driver.find_element(By.XPATH, "//*[text()='Description']/following::textarea")
-      desc_field.send_keys("Feedback på de digitala kompetenserna")
-      sleep(2)
-      save_button = self.driver.find_element(By.CLASS_NAME, "ms-ColumnManagementPanel-saveButton")
-      save_button.click()
-      sleep(2)
+      self._run_steps(_add_multiple_lines_column_steps, {'name': "Feedback", 'description': "Feedback på de digitala kompetenserna"})
       
       # Add entry for participant
-      new_button = self.driver.find_element(By.XPATH, "//*[text()='New']")
-      new_button.click()
-      sleep(2)
-      title_field = self.driver.find_element(By.XPATH, "//*[text()='Title']/following::input[@type='text'][position()=1]")
+      self.click(*_new_item)
+      title_field = self.wait_for(By.XPATH, _item_fields[0])
       title_field.send_keys('Hela kartläggningen')
-      sleep(2)
-      edit_button = self.driver.find_element(By.CSS_SELECTOR, "[aria-label='Edit']")
-      edit_button.click()
-      sleep(2)
-      iframe = self.driver.find_element(By.TAG_NAME, "iframe")
-      self.driver.switch_to.frame(iframe)
-      sleep(2)
-      text_field = self.driver.find_element(By.CSS_SELECTOR, "[aria-label='Rich text editor Feedback']")
+      self.click(By.CSS_SELECTOR, "[aria-label='Edit']")
+      self.wait.until(EC.frame_to_be_available_and_switch_to_it((By.TAG_NAME, "iframe")))
+      text_field = self.wait_for(By.CSS_SELECTOR, "[aria-label='Rich text editor Feedback']")
       text_field.send_keys(participant.feedback_text)
-      sleep(2)
-      edit_button = self.driver.find_element(By.XPATH, "//*[text()='Edit']")
-      edit_button.click()
-      sleep(2)
-      save_button = self.driver.find_element(By.XPATH, "//*[text()='Save']")
-      save_button.click()
-      sleep(2)
+      self.click(By.XPATH, "//*[text()='Edit']")
+      self.click(*_save)
       # Exit the iframe again
       self.driver.switch_to.default_content()
-      sleep(2)
-      save_button = self.driver.find_element(By.XPATH, "//*[text()='Save']")
-      save_button.click()
+      self.click(*_save)
             
       self.set_read_privileges(participant, real_data)
       return
@@ -468,75 +796,56 @@ class password_connection(SharePointConnection):
    """
    Used for writing passwords to SharePoint
    """
-   def __init__(self, start_page_path, start_page_name, browser = 'Chrome', driver_directory_path = './Drivers'):
-      SharePointConnection.__init__(self, start_page_path, start_page_name, browser = browser, driver_directory_path = driver_directory_path)
+   def __init__(self, start_page_path, start_page_name, browser = 'Chrome', driver_directory_path = './Drivers', site_path = None, headless = False, verbose = True):
+      SharePointConnection.__init__(self, start_page_path, start_page_name, browser = browser, driver_directory_path = driver_directory_path, site_path = site_path, headless = headless, verbose = verbose)
       return
       
-   def make_id_pwd_list(self, participant, real_data):
+   def make_id_pwd_list(self, participant, real_data, add_as_member = True):
       """
       This should make a page with the user ID and password for one
       participant. However, note that this code is *very brittle* It could
       stop working at any moment due to some change of state in SharePoint
-      that I do not understand.
+      that I do not understand. If the participant has already been made a
+      member of the site, set add_as_member to False.
+      
+      If the connection knows the site path, all of this is instead done
+      through the REST API, which is both faster and less brittle.
       """
-      print('Began work at {}'.format(datetime.now().strftime('%X')))
-      self.go_to_start()      
-      self.add_participant_as_member(participant, real_data)
+      self._report('Began')
+      if self.site_path is not None:
+         self._make_id_pwd_list_by_REST(participant, real_data)
+         self._report('Completed')
+         return
+      if add_as_member:
+         self.add_participant_as_member(participant, real_data)
 
       # Create a new list
       self.create_list("Canvas-användarnamn och lösenord till {}".format(participant.name), participant)
       
       # Make columns in the new page
-      column_button = self.driver.find_element(By.XPATH, "//*[text()='Add column']")
-      column_button.click()
-      sleep(2)
-      single_line_choice = self.driver.find_element(By.XPATH, "//*[text()='Single line of text']")
-      single_line_choice.click()
-      sleep(2)
-      name_field = self.driver.find_element(By.XPATH, "//*[text()='Name']/following::input[@type='text']")
-      name_field.send_keys("Användarnamn")
-      sleep(2)
-      desc_field = self.driver.find_element(By.XPATH, "//*[text()='Description']/following::textarea")
-      desc_field.send_keys("Användarnamn till Canvas-kontot")
-      sleep(2)
-      save_button = self.driver.find_element(By.CLASS_NAME, "ms-ColumnManagementPanel-saveButton")
-      save_button.click()
-      sleep(2)
-      column_button = self.driver.find_element(By.XPATH, "//*[text()='Add column']")
-      column_button.click()
-      sleep(2)
-      single_line_choice = self.driver.find_element(By.XPATH, "//*[text()='Single line of text']")
-      single_line_choice.click()
-      sleep(2)
-      name_field = self.driver.find_element(By.XPATH, "//*[text()='Name']/following::input[@type='text']")
-      name_field.send_keys("Lösenord")
-      sleep(2)
-      desc_field = self.driver.find_element(By.XPATH, "//*[text()='Description']/following::textarea")
-      desc_field.send_keys("Lösenord till Canvas-kontot")
-      sleep(2)
-      save_button = self.driver.find_element(By.CLASS_NAME, "ms-ColumnManagementPanel-saveButton")
-      save_button.click()
-      sleep(2)
+      for internal_name, display_name, description in _id_pwd_columns:
+         self._run_steps(_add_single_line_column_steps, {'name': display_name, 'description': description})
       
       # Add entry for participant
-      new_button = self.driver.find_element(By.XPATH, "//*[text()='New']")
-      new_button.click()
-      sleep(5)
-      title_field = self.driver.find_element(By.XPATH, "//*[text()='Title']/following::input[@type='text'][position()=1]")
-      title_field.send_keys(participant.name)
-      sleep(2)
-      userid_field = self.driver.find_element(By.XPATH, "//*[text()='Title']/following::input[@type='text'][position()=2]")
-      userid_field.send_keys(participant.username)
-      sleep(2)
-      pwd_field = self.driver.find_element(By.XPATH, "//*[text()='Title']/following::input[@type='text'][position()=3]")
-      pwd_field.send_keys(participant.password)
-      sleep(2)
-      save_button = self.driver.find_element(By.XPATH, "//*[text()='Save']")
-      save_button.click()
-      sleep(2)
+      self.click(*_new_item)
+      self.fill_fields(_item_fields, [participant.name, participant.username, participant.password], then_click = _save[1])
       
       self.set_read_privileges(participant, real_data)
-      print('Completed work at {}'.format(datetime.now().strftime('%X')))
+      self._report('Completed')
+      return
+
+   def _make_id_pwd_list_by_REST(self, participant, real_data):
+      """
+      Make the list for one participant without clicking anything: create
+      the list and its columns, add the entry and give the participant sole
+      read access. Having read access to a list lets them into the site as
+      far as needed, so they need not be made members first.
+      """
+      title = participant.name
+      self.rest('POST', 'web/lists', {'Title': title, 'Description': "Canvas-användarnamn och lösenord till {}".format(participant.name), 'BaseTemplate': 100})
+      self.add_id_pwd_columns(title)
+      self.rest('POST', '{}/items'.format(_list_path(title)), _id_pwd_fields(participant))
+      self.grant_sole_read_access(_list_path(title), participant, real_data)
       return
 
    def check_id_pwd_list(self, participant):
@@ -544,17 +853,70 @@ class password_connection(SharePointConnection):
       Verify that an already existing list for a participant has been written
       correctly.
       """
-      print('Began work at {}'.format(datetime.now().strftime('%X')))
+      self._report('Began')
+      if self.site_path is not None:
+         verified = self._check_id_pwd_list_by_REST(participant)
+         self._report('Completed')
+         return verified
       self.go_to_start()
       try:
-         sleep(5)
-         list_button = self.driver.find_element(By.XPATH, "//*[text()='{}']".format(participant.name))
-         list_button.click()
-         sleep(5)
-         self.driver.find_element(By.XPATH, "//*[text()='{}']".format(participant.username))
-         self.driver.find_element(By.XPATH, "//*[text()='{}']".format(participant.password))
+         self.click(By.XPATH, "//*[text()='{}']".format(participant.name))
+         self.wait_for(By.XPATH, "//*[text()='{}']".format(participant.username))
+         self.wait_for(By.XPATH, "//*[text()='{}']".format(participant.password))
          verified = True
-      except NoSuchElementException:
+      except TimeoutException:
          verified = False
-      print('Completed work at {}'.format(datetime.now().strftime('%X')))
+      self._report('Completed')
       return verified
+
+   def _check_id_pwd_list_by_REST(self, participant):
+      """
+      Fetch the items of the list for a participant as JSON and look for
+      their username and password among the values. The columns are looked
+      up by value rather than by name, since SharePoint mangles the internal
+      names of columns with umlauts in them.
+      """
+      try:
+         items = self.rest('GET', '{}/items'.format(_list_path(participant.name)))
+      except requests.HTTPError:
+         return False
+      for item in items['value']:
+         values = item.values()
+         if participant.username in values and participant.password in values:
+            return True
+      return False
+
+   def create_shared_id_pwd_list(self, title):
+      """
+      Create a single list that will hold the usernames and passwords of all
+      participants, one item each. This is the alternative to making one list
+      per participant, and saves us from going through the whole procedure of
+      creating a list and changing its permissions for every participant.
+      """
+      self.rest('POST', 'web/lists', {'Title': title, 'BaseTemplate': 100})
+      self.add_id_pwd_columns(title)
+      return
+
+   def add_id_pwd_columns(self, title):
+      """
+      Add the username and password columns to a list, through the REST API
+      rather than by clicking through the column dialog twice. SharePoint
+      only takes one field per call, so this is still two requests.
+      """
+      for internal_name, display_name, description in _id_pwd_columns:
+         schema = "<Field Type='Text' Name='{}' StaticName='{}' DisplayName='{}' Description='{}' />".format(internal_name, internal_name, display_name, description)
+         # 8 means that the name we give is the internal name, 16 that the
+         # column is shown in the default view of the list
+         self.rest('POST', '{}/fields/createfieldasxml'.format(_list_path(title)), {'parameters': {'SchemaXml': schema, 'Options': 8 + 16}})
+      return
+
+   def add_id_pwd_item(self, title, participant, real_data):
+      """
+      Add the username and password of a participant to the shared list, and
+      make that item readable by them and noone else.
+      """
+      self._report('Began')
+      item = self.rest('POST', '{}/items'.format(_list_path(title)), _id_pwd_fields(participant))
+      self.grant_sole_read_access('{}/items({})'.format(_list_path(title), item['Id']), participant, real_data)
+      self._report('Completed')
+      return
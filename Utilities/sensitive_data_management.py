@@ -19,16 +19,81 @@ https://github.com/Alvin-Gavel/Demodigi
 """
 
 import os
+import importlib.util
+from functools import cached_property
 import numpy as np
 
 import json
+import csv
 import pandas as pd
+import openpyxl
 import base64
 import hashlib as hl
+
+# The calamine engine reads Excel files much faster than openpyxl, but
+# needs the package python-calamine, which is not always installed, and
+# pandas 2.2 or later, which is the first version that knows of it.
+_pandas_version = tuple(int(part) for part in pd.__version__.split('.')[:2])
+if _pandas_version >= (2, 2) and importlib.util.find_spec('python_calamine') is not None:
+   _excel_engine = 'calamine'
+else:
+   _excel_engine = None
    
 # This module is secret, meaning it cannot be included in the repository.
 from hash_username import hash_username
 
+def hash_usernames(codes, salt):
+   """
+   Hash a whole list of five-character codes into usernames in one go,
+   returning them as a list of strings. Codes that occur more than once
+   are only hashed once.
+   """
+   hashed = {code: hash_username(code, salt).decode() for code in set(codes)}
+   return [hashed[code] for code in codes]
+
+def _split_evenly(items, n_chunks):
+   """
+   Split a list into n_chunks consecutive slices whose lengths differ by at
+   most one, the same way as np.array_split but without copying the list
+   into an array.
+   """
+   size, remainder = divmod(len(items), n_chunks)
+   chunks = []
+   start = 0
+   for i in range(n_chunks):
+      stop = start + size + (i < remainder)
+      chunks.append(items[start:stop])
+      start = stop
+   return chunks
+
+def _columns_to_excel(columns, file_path):
+   """
+   Write a dictionary of columns to an Excel file, with one sheet per key
+   and the name of each column as the header of its sheet. This goes
+   directly through a write-only openpyxl workbook, which is a lot less
+   work than pandas' to_excel for such small tables.
+   """
+   workbook = openpyxl.Workbook(write_only = True)
+   for sheet_name, column in columns.items():
+      sheet = workbook.create_sheet(sheet_name)
+      sheet.append([column.name])
+      for value in column:
+         sheet.append([None if pd.isna(value) else value])
+   workbook.save(file_path)
+   return
+
+def _format_person_numbers(person_numbers):
+   """
+   Insert a dash before the last four digits of a series of person numbers,
+   which may be either ten or twelve digits long. Missing person numbers
+   are replaced by 'Ej känt'.
+   """
+   expected_format = person_numbers.str.len().isin([10, 12])
+   for person_number in person_numbers[person_numbers.notna() & ~expected_format]:
+      print('Person number {} does not match expected format'.format(person_number))
+   dashed = person_numbers.str[:-4] + '-' + person_numbers.str[-4:]
+   return dashed.where(expected_format, person_numbers).fillna('Ej känt')
+
 class HR_data:
    def __init__(self, salt, source_file_path, target_folder_path, manipulations = []):
       self.salt = salt
@@ -46,24 +111,41 @@ class HR_data:
    def make_usernames(self):
       """
       Make usernames based on the five-character codes, and save the mapping
-      in three formats for ease of access.
+      as a table. Lookups in either direction are made from the table the
+      first time they are needed.
       """
-      self.mapping_code_username = {}
-      self.mapping_username_code = {}
-
       codes = list(self.HR['5-ställig kod'])
-      IDs = []
-      for code in codes:
-         ID = hash_username(code, self.salt).decode()
-         IDs.append(ID)
-         self.mapping_code_username[code] = ID
-         self.mapping_username_code[ID] = code
+      IDs = hash_usernames(codes, self.salt)
+      # Lookups made from any previous mapping are now out of date
+      self.__dict__.pop('mapping_code_username', None)
+      self.__dict__.pop('mapping_username_code', None)
       self.usernames = np.asarray(IDs)
       self.n_users = len(self.usernames)
       self.mapping = pd.DataFrame(data={'user_id': IDs, '5-ställig kod':codes})
-      self.mapping.to_csv('{}mapping.csv'.format(self.target_folder_path), index = False)
+      with open('{}mapping.csv'.format(self.target_folder_path), 'w', newline = '', encoding = 'utf-8') as f:
+         writer = csv.writer(f, lineterminator = os.linesep)
+         writer.writerow(['user_id', '5-ställig kod'])
+         writer.writerows(zip(IDs, codes))
+      # Any SIS data made from the previous usernames is now out of date
+      self.SIS_data = None
       return
    
+   @cached_property
+   def mapping_code_username(self):
+      """
+      Series giving the username of each five-character code.
+      """
+      unique = self.mapping.drop_duplicates('5-ställig kod')
+      return pd.Series(unique['user_id'].values, index = unique['5-ställig kod'].values)
+   
+   @cached_property
+   def mapping_username_code(self):
+      """
+      Series giving the five-character code of each username.
+      """
+      unique = self.mapping.drop_duplicates('user_id')
+      return pd.Series(unique['5-ställig kod'].values, index = unique['user_id'].values)
+   
    def infer_version_names(self):
       """
       Based on the n manipulations, come up with names for the 2^n versions
@@ -90,12 +172,15 @@ class HR_data:
       assigned to.
       """
       flags = {}
+      encoded_manipulations = {}
       for manipulation in self.manipulations:
          flags[manipulation] = []
-      
+         encoded_manipulations[manipulation] = manipulation.encode(encoding='UTF-8')
+
       for code in self.HR['5-ställig kod'].values:
+         encoded_code = code.encode(encoding='UTF-8')
          for manipulation in self.manipulations:
-            hashed = hl.sha1('{}{}'.format(code,manipulation).encode(encoding='UTF-8'))
+            hashed = hl.sha1(encoded_code + encoded_manipulations[manipulation])
             digested = hashed.digest()
             b64encoded = base64.b64encode(digested)
             flags[manipulation].append(b64encoded[0] % 2 == 0)
@@ -110,43 +195,39 @@ class HR_data:
       """
       if verbose:
          print("Reading HR file")
-      HR = pd.read_excel(self.source_file_path, names = ['5-ställig kod', 'Personnr', 'Efternamn', 'Förnamn', 'Orgnr', 'Orgenhet', 'e-post', 'konsult', 'VO', 'Region'], dtype = str)
+      # The file also has the columns Orgnr, Orgenhet and VO, but since we
+      # never use them they are not read at all
+      HR = pd.read_excel(self.source_file_path, usecols = [0, 1, 2, 3, 6, 7, 9], names = ['5-ställig kod', 'Personnr', 'Efternamn', 'Förnamn', 'e-post', 'konsult', 'Region'], dtype = str, engine = _excel_engine)
       full_length = len(HR.index)
       if verbose:
          print("Read {} in total".format(full_length))
-      HR = HR[HR['konsult'] != 'Ja']
+      # Only the consult column needs to be cleaned up before dropping the
+      # consults, the rest can wait until there are fewer rows to strip
+      HR = HR[HR['konsult'].str.strip() != 'Ja']
       length = len(HR.index)
       if verbose:
          print("Of these, {} remain after dropping consults".format(length))
          
       # For some reason the lists we get from the HR department have a lot
       # of trailing whitespace
-      for key in HR.keys():
-         HR[key] = HR[key].str.strip()
-      self.HR = HR
+      self.HR = HR.apply(lambda column: column.str.strip())
+      
+      # Row of the first employee with each code, so that the HR data can
+      # be looked up by code without scanning the whole list every time
+      codes = self.HR['5-ställig kod'].values
+      self.HR_row_by_code = dict(zip(codes[::-1], range(len(codes) - 1, -1, -1)))
       return
 
    def make_SIS_data(self):
       """
       Given a list of five-character codes and a salt, use them to generate
-      the account names used by SSO.
+      the account names used by SSO. The result is kept until the usernames
+      change, so calling this repeatedly is cheap.
       """
-      user_IDs = []
-      login_IDs = []
-      authentication_provider = []
-      first_name = []
-      last_name = []
-      fake_emails = []
-      status = []
-      for ID in self.usernames:
-         user_IDs.append(ID)
-         login_IDs.append(ID)
-         authentication_provider.append('openid_connect')
-         first_name.append('Af'),
-         last_name.append('Student')
-         fake_emails.append('{}@arbetsformedlingen.se'.format(ID))
-         status.append('active')
-      self.SIS_data = pd.DataFrame(data={'user_id':user_IDs, 'login_id':login_IDs, 'authentication_provider_id':authentication_provider, 'first_name':first_name, 'last_name':last_name, 'email':fake_emails, 'status':status})
+      if self.SIS_data is not None:
+         return
+      user_IDs = pd.Series(self.usernames, dtype = str)
+      self.SIS_data = pd.DataFrame(data={'user_id':user_IDs, 'login_id':user_IDs, 'authentication_provider_id':'openid_connect', 'first_name':'Af', 'last_name':'Student', 'email':user_IDs + '@arbetsformedlingen.se', 'status':'active'})
       return
    
    def export_SIS_data(self):
@@ -179,22 +260,23 @@ class HR_data:
       """
       Make lists of email adresses per region.
       """
-      regions = set(self.HR['Region'])
-      regions.discard(np.nan)
       with pd.ExcelWriter('{}Mail_per_region.xlsx'.format(self.target_folder_path)) as f:
-         for region in regions:
-            correct_region = self.HR[self.HR['Region'] == region]
-            correct_region['e-post'].to_excel(f, index = False, sheet_name = region)
+         for region, emails in self.HR['e-post'].groupby(self.HR['Region']):
+            emails.to_excel(f, index = False, sheet_name = region)
       return
     
-   def export_bureaucracy(self):
+   def export_bureaucracy(self, single_file = False):
       """
       For bureaucratic reasons, we need to deliver one file of first names,
-      one file of lastnames and also a file of user IDs.
+      one file of lastnames and also a file of user IDs. If single_file is
+      set, these are instead delivered as three sheets of one file.
       """
-      self.SIS_data['user_id'].to_excel('{}Användarnamn.xlsx'.format(self.target_folder_path), index=False)
-      self.HR['Förnamn'].to_excel('{}Förnamn.xlsx'.format(self.target_folder_path), index=False)
-      self.HR['Efternamn'].to_excel('{}Efternamn.xlsx'.format(self.target_folder_path), index=False)
+      columns = {'Användarnamn': self.SIS_data['user_id'], 'Förnamn': self.HR['Förnamn'], 'Efternamn': self.HR['Efternamn']}
+      if single_file:
+         _columns_to_excel(columns, '{}Byråkrati.xlsx'.format(self.target_folder_path))
+      else:
+         for name, column in columns.items():
+            _columns_to_excel({'Sheet1': column}, '{}{}.xlsx'.format(self.target_folder_path, name))
       return
    
    def export_manipulations(self):
@@ -222,9 +304,7 @@ class HR_data:
       for version in self.versions:
          mail_lists[version] = []
       
-      for i in range(self.n_users):
-         mail = self.SIS_data['email'].values[i]
-         ID = self.SIS_data['user_id'].values[i]
+      for i, mail in enumerate(self.SIS_data['email'].tolist()):
          flags = []
          for manipulation in self.manipulations:
             if self.flags[manipulation][i]:
@@ -243,14 +323,9 @@ class HR_data:
       
       for version in self.versions:
          mail_list = mail_lists[version]
-         chunks = np.array_split(mail_list, n_chunks)
-         
-         for i in range(n_chunks):
-            chunk = chunks[i]
-            mail_string = ', '.join(chunk)            
-            f = open('{}email_string_{}_{}.txt'.format(self.target_folder_path, version, i), 'w')
-            f.write(mail_string)
-            f.close()
+         for i, chunk in enumerate(_split_evenly(mail_list, n_chunks)):
+            with open('{}email_string_{}_{}.txt'.format(self.target_folder_path, version, i), 'w') as f:
+               f.write(', '.join(chunk))
       return
    
    def transform_real_email_to_fake(self, mailstring):
@@ -308,17 +383,13 @@ class HR_data:
       a file with a single column of their email adresses, assuming that they
       can be found in the file of HR data. 
       """
-      f = open(source_file_path)
-      IDs = [word.strip() for word in f]
-      f.close()
-      emails = []
-      for ID in IDs:
-         try:
-            # This is almost certainly not the correct way of doing this, but it works
-            email = list(self.HR['e-post'][self.HR['5-ställig kod'] == self.mapping_username_code[ID.replace('@arbetsformedlingen.se', '')]])[0]
-            emails.append(email)
-         except KeyError:
-            print('Could not find mail for user id {}'.format(ID))
+      with open(source_file_path) as f:
+         IDs = pd.Series([word.strip() for word in f], dtype = object)
+      rows = IDs.str.removesuffix('@arbetsformedlingen.se').map(self.mapping_username_code).map(self.HR_row_by_code)
+      known = rows.notna()
+      for ID in IDs[~known]:
+         print('Could not find mail for user id {}'.format(ID))
+      emails = self.HR['e-post'].values[rows[known].astype(int)]
       mail_pd = pd.DataFrame(data={'email':emails})
       mail_pd.to_csv('{}emails.txt'.format(self.target_folder_path), index = False)
       return
@@ -333,29 +404,18 @@ class HR_data:
       """
       SCB_prelim = pd.read_csv(source_file_path, names = ['Användarnamn', 'Uppskattad tid', 'Startdatum', 'Avslutsdatum'], dtype = str, skiprows = [0])
       
-      person_numbers = []
-      emails = []
-      regions = []
-      for ID in SCB_prelim['Användarnamn']:
-         try:
-            correct_person = self.HR['5-ställig kod'] == self.mapping_username_code[ID.replace('@arbetsformedlingen.se', '')]
-            person_number = list(self.HR['Personnr'][correct_person])[0]
-            if len(person_number) == 10:
-               person_number = person_number[:6] + '-' + person_number[6:]
-            elif len(person_number) == 12:
-               person_number = person_number[:8] + '-' + person_number[8:]
-            else:
-               print('Person number {} does not match expected format'.format(person_number))
-            person_numbers.append(person_number)
-            emails.append(list(self.HR['e-post'][correct_person])[0])
-            
-            region = list(self.HR['Region'][correct_person])[0]
-            regions.append(region)
-         except KeyError:
-            print('Could not find person number for user id {}'.format(ID))
-            person_numbers.append('Ej känt')
-            emails.append('Ej känd')
-            regions.append('Ej känd')      
+      # Look up everyone's row in the HR data in one go, rather than one
+      # user at a time
+      user_IDs = SCB_prelim['Användarnamn'].str.removesuffix('@arbetsformedlingen.se')
+      rows = user_IDs.map(self.mapping_username_code).map(self.HR_row_by_code)
+      known = rows.notna()
+      for ID in SCB_prelim['Användarnamn'][~known]:
+         print('Could not find person number for user id {}'.format(ID))
+      known_HR = self.HR.iloc[rows[known].astype(int)].set_index(rows.index[known]).reindex(SCB_prelim.index)
+      
+      person_numbers = _format_person_numbers(known_HR['Personnr'])
+      emails = known_HR['e-post'].where(known, 'Ej känd')
+      regions = known_HR['Region'].where(known, 'Ej känd')
       SCB_first_page = SCB_prelim[['Uppskattad tid', 'Startdatum', 'Avslutsdatum']].copy()
       SCB_first_page.insert(0, 'Personnummer', person_numbers)
       
@@ -363,13 +423,9 @@ class HR_data:
       SCB_following_pages['e-post'] = emails
       SCB_following_pages['Region'] = regions
       
-      all_regions = set(regions)
-      all_regions.discard(np.nan)
-      
       with pd.ExcelWriter(target_file_path) as f:
          SCB_first_page.to_excel(f, index = False, sheet_name = 'Samtliga')
          
-         for region in sorted(list(all_regions)):
-            correct_region = SCB_following_pages['Region'] == region
-            SCB_following_pages[correct_region].to_excel(f, index = False, sheet_name = region)
+         for region, correct_region in SCB_following_pages.groupby('Region'):
+            correct_region.to_excel(f, index = False, sheet_name = region)
       return
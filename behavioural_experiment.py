@@ -42,12 +42,22 @@ https://github.com/Alvin-Gavel/Demodigi
 """
 
 import numbers as nb
+import math
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import scipy.special as sp
+import scipy.signal as sg
 import numpy.random as rd
 import matplotlib.pyplot as plt
 
+# Numba is not needed, but makes calculate_p faster if available
+try:
+   import numba
+   _jit = numba.njit(cache = True)
+except ImportError:
+   _jit = lambda function: function
+
 ### Magic numbers, will probably be incorporated into a class at some point
 
 # When estimating the probability distribution p over some probability P,
@@ -57,15 +67,62 @@ _p_steps = 101
 _d_steps = 2 * _p_steps - 1
 _D_sample_width = 1/ _d_steps
 
+# The values of P over which p is calculated, and their logarithms, which
+# are the same every time
+_P_range = np.linspace(0.0, 1.0, num=_p_steps)
+_P_sample_width = 1 / _p_steps
+with np.errstate(divide = 'ignore'):
+   _log_P = np.log(_P_range)
+   _log_1mP = np.log(1 - _P_range)
+# Likewise for the values of D over which d is calculated
+_D_range = np.linspace(-1.0, 1.0, num=_d_steps)
+# These are handed out to every caller rather than copied, so they are made
+# read-only, lest anyone changing their own copy change them for everyone
+_P_range.setflags(write = False)
+_log_P.setflags(write = False)
+_log_1mP.setflags(write = False)
+_D_range.setflags(write = False)
+
+# Shared by all simulated trials, rather than seeding a new generator for
+# every one of them
+_rng = rd.default_rng()
+
+# The figure that all plots are drawn in, created when first needed
+_figure = None
+_axes = None
+
+def _cleared_axes():
+   """
+   Return the figure and axes to plot in, emptied of whatever was plotted
+   before. The same ones are reused for every plot, unless the figure has
+   been closed, rather than setting up new ones each time.
+   """
+   global _figure, _axes
+   if _figure is None or not plt.fignum_exists(_figure.number):
+      _figure, _axes = plt.subplots()
+   _axes.cla()
+   # cla() leaves the tick settings alone, so undo the rotated labels of
+   # plot_d here, or they carry over into whatever is plotted next
+   _axes.tick_params(axis = 'x', labelrotation = 0)
+   return _figure, _axes
+
 def _index_of_nearest(array, value):
    """
    Thanks to unutbu of Stackoverflow:
    https://stackoverflow.com/questions/2566412/find-nearest-value-in-numpy-array
+   
+   Assumes that the array is sorted in increasing order, as all our ranges
+   are, so that we can do a binary search rather than look at every element.
    """
    array = np.asarray(array)
-   idx = (np.abs(array - value)).argmin()
+   idx = np.searchsorted(array, value)
+   if idx > 0 and (idx == len(array) or abs(array[idx - 1] - value) <= abs(array[idx] - value)):
+      idx -= 1
    return idx
 
+# Where in _D_range that D = 0
+_zero_diff = _index_of_nearest(_D_range, 0)
+
 ### Statistical analysis
 
 def logB(alpha, beta):
@@ -73,11 +130,11 @@ def logB(alpha, beta):
    The logarithm of the normalisation factor that appears when doing
    Bayesian fitting of binomial functions
    """
-   return sp.loggamma(alpha) + sp.loggamma(beta) - sp.loggamma(alpha + beta)
+   return sp.betaln(alpha, beta)
 
 def test_normalisation(p, sample_width):
    p_mass = p * sample_width
-   total_mass = sum(p_mass)
+   total_mass = p_mass.sum()
    if np.abs(total_mass - 1) > 0.01:
       print("Problem in calculation!")
       print("Probability density function not well normalised")
@@ -89,7 +146,7 @@ def binomial_trial(n, P):
    Make a single iteration of the experiment, with n participants, for a
    given value of P.
    """
-   return np.sum(rd.random(n) < P)
+   return int(_rng.binomial(n, P))
 
 def calculate_p(n, S):
    """
@@ -98,15 +155,34 @@ def calculate_p(n, S):
 
    Returns an array containing the probability distribution p over P.
    """
-   p_sample_width = 1 / _p_steps
-   P_range = np.linspace(0.0, 1.0, num=_p_steps)
-   
-   with np.errstate(divide = 'ignore'):
-     log_p = S * np.log(P_range) + (n - S) * np.log(1 - P_range) - logB(S + 1, n - S + 1)
-      
+   return _P_range, _calculate_p_compiled(n, S, _log_P, _log_1mP, _P_sample_width)
+
+@_jit
+def _calculate_p_compiled(n, S, log_P, log_1mP, sample_width):
+   """
+   The actual calculation in calculate_p, written so that Numba can compile
+   it. Hence the use of math.lgamma rather than logB.
+   """
+   log_B = math.lgamma(S + 1) + math.lgamma(n - S + 1) - math.lgamma(n + 2)
+   log_p = S * log_P + (n - S) * log_1mP - log_B
+   p = np.exp(log_p)
+   p_mass = p * sample_width
+   return p_mass
+
+def _calculate_p_batch(n, S):
+   """
+   Does the same as calculate_p, but for an array of results S from trials
+   that all had n participants. Returns a 2D array with one distribution
+   per row.
+   """
+   # S can only take the values 0 to n, so rather than evaluating logB for
+   # every trial we look up the log-gamma functions it is made up of
+   log_gamma = sp.gammaln(np.arange(1, n + 3))
+   log_B = log_gamma[S] + log_gamma[n - S] - log_gamma[n + 1]
+   log_p = np.multiply.outer(S, _log_P) + np.multiply.outer(n - S, _log_1mP) - log_B[:, np.newaxis]
    p = np.exp(log_p)
-   p_mass = p * p_sample_width
-   return P_range, p_mass
+   p_mass = p * _P_sample_width
+   return p_mass
 
 def calculate_d(p_pre, p_post):
    """
@@ -114,18 +190,42 @@ def calculate_d(p_pre, p_post):
    P_post, calculates the probability distribution d over the difference D
    between p_pre and p_post.
    """
-   D_range = np.linspace(-1.0, 1.0, num=_d_steps)
-   d_mass = np.convolve(p_post, np.flip(p_pre))
-   return D_range, d_mass
+   # Lets scipy choose between direct and FFT convolution, since which is
+   # faster depends on _p_steps
+   d_mass = sg.convolve(p_post, np.flip(p_pre), method = 'auto')
+   return _D_range, d_mass
 
 def estimate_pDpos(D_range, d):
    """
    Given a probability distribution d over the difference in quality D,
    calculate the probability that D is positive.
    """
-   zero_diff = _index_of_nearest(D_range, 0)
+   # Since _D_range is read-only, if it is the one we were given then
+   # _zero_diff still holds for it
+   if D_range is _D_range:
+      zero_diff = _zero_diff
+   else:
+      zero_diff = _index_of_nearest(D_range, 0)
    return np.sum(d[zero_diff:])
 
+def _estimate_pDpos_batch(p_pre, p_post):
+   """
+   Does the same as calculate_d followed by estimate_pDpos, but for arrays
+   holding one pair of distributions per row. D is non-negative whenever
+   P_post is at least P_pre, so rather than convolving, each value of p_post
+   is weighed by the total probability of P_pre being at most that large.
+   """
+   return np.sum(p_post * np.cumsum(p_pre, axis = 1), axis = 1)
+
+def _median_pDpos(n, P_pre, P_post, iterations, seed):
+   """
+   Simulate a number of experiment runs with n participants, split evenly
+   between pre and post, and return the median of pDpos. This takes a seed
+   rather than using _rng, so that it can be run in a process of its own.
+   """
+   batch = experiment_batch(n // 2, n // 2, P_pre, P_post, iterations, rng = rd.default_rng(seed))
+   return np.nanmedian(batch.pDpos)
+
 ### The actual experiment
 
 class experiment_run:
@@ -213,50 +313,126 @@ class experiment_run:
       self.plot_folder = ''
       return
       
-   def _plot_with_dot(self, x_range, y_range, label, x_mark):
+   def _plot_with_dot(self, axes, x_range, y_range, label, x_mark):
       """
       Plot the function f(x), with a dot located on the curve at some
       specific value of x.
       """
-      plt.plot(x_range, y_range, label = label)
+      axes.plot(x_range, y_range, label = label)
       y_mark = y_range[_index_of_nearest(x_range, x_mark)]
-      plt.scatter(x_mark, y_mark, s = 10)
+      axes.scatter(x_mark, y_mark, s = 10)
       return
       
    def plot_p(self):
       """
       Plot the probability distributions p(P) for the two participant groups.
       """
-      plt.clf()
-      self._plot_with_dot(self.P_range, self.p_pre, 'pre', self.P_pre)
-      self._plot_with_dot(self.P_range, self.p_post, 'post', self.P_post)
-      plt.xlim(0, 1)
-      plt.xlabel(r"$P$")
-      plt.ylabel(r"$p\left( P \right)$")
-      plt.xticks(ticks=np.linspace(0, 1, 11, endpoint=True))
-      plt.legend()
+      figure, axes = _cleared_axes()
+      self._plot_with_dot(axes, self.P_range, self.p_pre, 'pre', self.P_pre)
+      self._plot_with_dot(axes, self.P_range, self.p_post, 'post', self.P_post)
+      axes.set_xlim(0, 1)
+      axes.set_xlabel(r"$P$")
+      axes.set_ylabel(r"$p\left( P \right)$")
+      axes.set_xticks(np.linspace(0, 1, 11, endpoint=True))
+      axes.legend()
       if self.plot_folder == '':
          plt.show()
       else:
-         plt.savefig('./{}/ill_{}_p.png'.format(self.plot_folder, self.name))
+         figure.savefig('./{}/ill_{}_p.png'.format(self.plot_folder, self.name))
       return
    
    def plot_d(self):
       """
       Plot the probability distribution d(D) for the participants.
       """
-      plt.clf()
-      self._plot_with_dot(self.D_range, self.d, 'diff', 0.0)
-      plt.fill_between(self.D_range, self.d, where = self.D_range > 0, step="mid", alpha=0.4)
-      plt.xlim(-1, 1)
-      plt.title(r"$P\left( D > 0 \right) = {:.2f}$".format(self.pDpos))
-      plt.xlabel(r"$D$")
-      plt.ylabel(r"$d\left( D \right)$")
-      plt.xticks(ticks=np.linspace(-1, 1, 21, endpoint=True), rotation = 90)
+      figure, axes = _cleared_axes()
+      self._plot_with_dot(axes, self.D_range, self.d, 'diff', 0.0)
+      axes.fill_between(self.D_range, self.d, where = self.D_range > 0, step="mid", alpha=0.4)
+      axes.set_xlim(-1, 1)
+      axes.set_title(r"$P\left( D > 0 \right) = {:.2f}$".format(self.pDpos))
+      axes.set_xlabel(r"$D$")
+      axes.set_ylabel(r"$d\left( D \right)$")
+      axes.set_xticks(np.linspace(-1, 1, 21, endpoint=True))
+      axes.tick_params(axis = 'x', labelrotation = 90)
       if self.plot_folder == '':
          plt.show()
       else:
-         plt.savefig('./{}/ill_{}_d.png'.format(self.plot_folder, self.name))
+         figure.savefig('./{}/ill_{}_d.png'.format(self.plot_folder, self.name))
+      return
+
+class experiment_batch:
+   """
+   This represents a number of runs of the experiment, all with the same
+   numbers of participants and the same P_pre and P_post. The runs give the
+   same results as that many experiment_runs would, but are all done at
+   once and stored in arrays with one element, or row, per run. Unlike
+   experiment_run, it does not store d(D), which is only needed for
+   plotting.
+   
+   Attributes
+   ----------
+   n_pre : int
+   \tThe number of participants who have not yet taken the learning module
+   n_post : int
+   \tThe number of participants who have taken the learning module
+   P_pre : float
+   \tThe probability that a participant who has not taken the learning
+   \tmodule will perform the desired behaviour
+   P_post : float
+   \tThe probability that a participant who has taken the learning module
+   \twill perform the desired behaviour
+   iterations : int
+   \tThe number of experiment runs
+   S_pre : int ndarray
+   \tFor each run, the number of participants who have not taken the
+   \tlearning module who still ended up performing the desired behaviour
+   S_post : int ndarray
+   \tFor each run, the number of participants who have taken the learning
+   \tmodule who end up performing the desired behaviour
+   p_pre : float ndarray
+   \tThe probability distributions p(P) over _P_range for the participants
+   \twho have not yet taken the learning module, with one row per run
+   p_post : float ndarray
+   \tThe probability distributions p(P) over _P_range for the participants
+   \twho have taken the learning module, with one row per run
+   pDpos : float ndarray
+   \tFor each run, the probability that D is positive
+   """
+   def __init__(self, n_pre, n_post, P_pre, P_post, iterations, rng = None):
+      """
+      Parameters
+      ----------
+      n_pre : int
+      \tDescribed under attributes
+      n_post : int
+      \tDescribed under attributes
+      P_pre : float
+      \tDescribed under attributes
+      P_post : float
+      \tDescribed under attributes
+      iterations : int
+      \tDescribed under attributes
+      
+      Optional parameters
+      -------------------
+      rng : numpy Generator
+      \tThe random number generator to draw the results from. If none is
+      \tgiven, the one shared by the whole module is used.
+      """
+      if rng is None:
+         rng = _rng
+      self.n_pre = n_pre
+      self.n_post = n_post
+      self.P_pre = P_pre
+      self.P_post = P_post
+      self.iterations = iterations
+      
+      self.S_pre = rng.binomial(self.n_pre, self.P_pre, size = self.iterations)
+      self.S_post = rng.binomial(self.n_post, self.P_post, size = self.iterations)
+      
+      self.p_pre = _calculate_p_batch(self.n_pre, self.S_pre)
+      self.p_post = _calculate_p_batch(self.n_post, self.S_post)
+      self.pDpos = _estimate_pDpos_batch(self.p_pre, self.p_post)
       return
 
 class varying_n:
@@ -348,7 +524,7 @@ class varying_n:
          return
 
       self.ns = np.linspace(self.n_min, self.n_max, num = self.n_steps, endpoint = True, dtype = np.int64)
-      self.median_pDpos = np.zeros((self.n_steps, self.P_steps), np.float64) * np.nan
+      self.median_pDpos = np.full((self.n_steps, self.P_steps), np.nan, dtype = np.float64)
       
       if name == '':
          if self.P_type == 'single P':
@@ -360,33 +536,43 @@ class varying_n:
       self.plot_folder = ''
       return
    
-   def run(self):
+   def run(self, n_processes = 1):
       """
       Start simulating experiment runs.
+      
+      Each combination of n and P is independent of the others, so if
+      n_processes is larger than 1 they are shared out between that many
+      processes. Setting it to None uses one process per CPU core. Note that
+      on Windows this requires the calling script to put everything under
+      if __name__ == '__main__'.
       """
-      for i in range(self.n_steps):
-         n = self.ns[i]
-         for j in range(self.P_steps):
-            pDpos = []
-            for k in range(self.iterations):
-               run = experiment_run(n // 2, n // 2, self.P_pre[j], self.P_post[j])
-               pDpos.append(run.pDpos)
-            self.median_pDpos[i, j] = np.nanmedian(pDpos)
+      cells = [(i, j) for i in range(self.n_steps) for j in range(self.P_steps)]
+      # Each combination gets a random stream of its own, independent of
+      # which process it ends up in
+      seeds = rd.SeedSequence(_rng.integers(2**63)).spawn(len(cells))
+      arguments = [(self.ns[i], self.P_pre[j], self.P_post[j], self.iterations, seed) for (i, j), seed in zip(cells, seeds)]
+      if n_processes == 1:
+         medians = [_median_pDpos(*cell_arguments) for cell_arguments in arguments]
+      else:
+         with ProcessPoolExecutor(max_workers = n_processes) as executor:
+            medians = list(executor.map(_median_pDpos, *zip(*arguments)))
+      for (i, j), median in zip(cells, medians):
+         self.median_pDpos[i, j] = median
       return
       
    def plot_pDpos(self):
       """
       Plot median pDpos as a function of n.
       """
-      plt.clf()
+      figure, axes = _cleared_axes()
       for m in range(self.P_steps):
-         plt.plot(self.ns, self.median_pDpos[:,m], label = r'$P_{{\mathrm{{pre}}}} = {}, P_{{\mathrm{{post}}}} = {}$'.format(self.P_pre[m], self.P_post[m]))
-      plt.xlabel(r"$n$")
-      plt.ylabel(r"$P\left( D > 0 \right)$")
-      plt.xlim(self.n_min, self.n_max)
-      plt.legend()
+         axes.plot(self.ns, self.median_pDpos[:,m], label = r'$P_{{\mathrm{{pre}}}} = {}, P_{{\mathrm{{post}}}} = {}$'.format(self.P_pre[m], self.P_post[m]))
+      axes.set_xlabel(r"$n$")
+      axes.set_ylabel(r"$P\left( D > 0 \right)$")
+      axes.set_xlim(self.n_min, self.n_max)
+      axes.legend()
       if self.plot_folder == '':
          plt.show()
       else:
-         plt.savefig('./{}/ill_{}_pDpos.png'.format(self.plot_folder, self.name))
+         figure.savefig('./{}/ill_{}_pDpos.png'.format(self.plot_folder, self.name))
       return
@@ -52,6 +52,7 @@ import os
 from abc import ABC, abstractmethod
 import numbers as nb
 import json
+from functools import lru_cache
 
 import numpy as np
 import numpy.random as rd
@@ -59,9 +60,31 @@ import scipy.special as sp
 import scipy.stats as st
 import matplotlib.pyplot as plt
 
+# Used by simulated participants that are not given a generator of their
+# own
+_rng = rd.default_rng()
+
 
 ### Tools for inspecting data
 
+# The categories that read_nested_dict sorts values into, and the types
+# that belong to each. Exact types can be looked up directly, and only
+# subclasses and other numbers need to go through isinstance.
+_sorting_types = {'Dictionary':(dict,), 'String':(str,), 'Collections not dict or ndarray':(list, set, tuple), 'Numpy ndarray':(np.ndarray,), 'Numerical':(nb.Number,)}
+_sorting_type_by_exact_type = {data_type: sorting_type_name for sorting_type_name, data_types in _sorting_types.items() for data_type in data_types}
+
+def _sorting_type_of(value):
+   """
+   The category that read_nested_dict puts value in
+   """
+   sorting_type_name = _sorting_type_by_exact_type.get(type(value))
+   if sorting_type_name is None:
+      for candidate_name, data_types in _sorting_types.items():
+         if isinstance(value, data_types):
+            return candidate_name
+      return 'Other data'
+   return sorting_type_name
+
 def read_nested_dict(dictionary):
    """
    In this module a lot of data is stored as nested dicts. This tool is
@@ -81,25 +104,17 @@ def read_nested_dict(dictionary):
       values = {'Other data':[]}
       
       sorting_type_nondict_order = ['Numpy ndarray', 'Collections not dict or ndarray', 'Numerical', 'String', 'Other data']
-      sorting_types = {'Dictionary':[dict], 'String':[str], 'Collections not dict or ndarray':[list, set, tuple], 'Numpy ndarray':[np.ndarray], 'Numerical':[nb.Number]}
-      for sorting_type_name, sorting_type_list in sorting_types.items():
+      for sorting_type_name in _sorting_types:
          keys[sorting_type_name] = []
          values[sorting_type_name] = []
       
       for key, value in dict_level.items():
-         found_type = False
-         for sorting_type_name, sorting_type_list in sorting_types.items():
-            for sorting_type in sorting_type_list:
-               if isinstance(value, sorting_type):
-                  keys[sorting_type_name].append(key)
-                  values[sorting_type_name].append(value)
-                  found_type = True
-         if not found_type:
-            keys['Other data'].append(key)
-            values['Other data'].append(value)
+         sorting_type_name = _sorting_type_of(value)
+         keys[sorting_type_name].append(key)
+         values[sorting_type_name].append(value)
    
       n = {}
-      for sorting_type_name in list(sorting_types.keys()) + ['Other data']:
+      for sorting_type_name in list(_sorting_types.keys()) + ['Other data']:
          n[sorting_type_name] = len(keys[sorting_type_name])
    
       print("Dictionaries:")
@@ -164,15 +179,15 @@ def read_nested_dict(dictionary):
 
 ### Internal functions for handling text
 
+# Characters that would not be suitable for a filename, mapped to what
+# they are replaced with, or to None if they are simply removed
+_filename_translation = str.maketrans({**{character: None for character in '\\"*/><|:;&?.'}, ' ': '_', ',': '_'})
+
 def _trim_for_filename(string):
    """
    Removes parts of a string that would not be suitable for a filename
    """
-   for character in ['\\', '"', '*' '/', '>', '<', '|', ':', ';', '&', '?', '.']:
-      string = string.replace(character, '')
-   for character in [' ', ',']:
-      string = string.replace(character, '_')      
-   return string
+   return string.translate(_filename_translation)
 
 def _is_are(n):
    word = "is" if n == 1 else "are" 
@@ -215,43 +230,52 @@ def _define_subgroups(n, BBVs_or_manipulations, BBV_or_manipulation_flags):
    arrays with the indices of those that are affected by the manipulation
    or BBV in question.
    """
+   if n == 0:
+      return {}
+   names = [BBV_or_manipulation.name for BBV_or_manipulation in BBVs_or_manipulations]
+   # One row per participant and one column per manipulation or BBV. Every
+   # distinct row is one group.
+   flags = np.zeros((n, len(names)), dtype = bool)
+   for j, name in enumerate(names):
+      flags[:,j] = BBV_or_manipulation_flags[name][:n]
+   group_flags, group_of_participant = np.unique(flags, axis = 0, return_inverse = True)
+   group_of_participant = group_of_participant.reshape(-1)
+   # A stable sort keeps the indices within each group in increasing order
+   members_by_group = np.split(np.argsort(group_of_participant, kind = 'stable'), np.cumsum(np.bincount(group_of_participant))[:-1])
+
+   # The groups are listed in the order that their first member appears
    groups = {}
-   group_names = set([])
-   for i in range(n):
-      flags = []
-      for BBV_or_manipulation in BBVs_or_manipulations:
-          if BBV_or_manipulation_flags[BBV_or_manipulation.name][i]:
-             flags.append(BBV_or_manipulation.name)
-      group_name = ", ".join(flags)
+   for row, members in sorted(zip(group_flags, members_by_group), key = lambda pair: pair[1][0]):
+      group_name = ", ".join([name for name, flag in zip(names, row) if flag])
       if group_name == "":
          group_name = "none"
-      if not (group_name in group_names):
-         groups[group_name] = []
-         group_names.add(group_name)
-      groups[group_name].append(i)
-   for group_name in group_names:
-      groups[group_name] = np.asarray(groups[group_name])
+      groups[group_name] = members
    return groups
 
+@lru_cache(maxsize = 8)
+def _quality_ranges(qk_samples):
+   """
+   The values of quality Qki and quality difference Dk that the probability
+   distributions are calculated over, given the number of samples in Qki.
+   These only depend on the number of participants, so studies of the same
+   learning module share them. They are made read-only for that reason.
+   """
+   Qki_range = np.linspace(0.0, 1.0, num=qk_samples)
+   Dk_range = np.linspace(-1.0, 1.0, num=2 * qk_samples - 1)
+   Qki_range.flags.writeable = False
+   Dk_range.flags.writeable = False
+   return Qki_range, Dk_range
+
 def ordinalise(ndarray):
    """
    Takes a 1-d ndarray and makes the data ordinal. That is to say, the
    elements will be turned into integers denoting the lowest, second
    lowest, etcetera.
    """
-   n = len(ndarray)
-   ordinal = np.zeros(n, dtype=np.int64)
-   sorted_array = np.unique(ndarray)
-
-   i = 0
-   j = 0 # Just in case somebody feeds this some really weird data
-   while i < n and j < n:
-      element = ndarray[i]
-      for index in np.where(sorted_array == element)[0]:
-         ordinal[i] = index
-         i += 1
-      j += 1
-   return ordinal
+   # The inverse returned by np.unique is the position of each element among
+   # the sorted unique values, which is exactly the ordinal
+   sorted_array, ordinal = np.unique(ndarray, return_inverse = True)
+   return ordinal.astype(np.int64)
    
 def ordinalise_many(ndarrays):
    """
@@ -272,7 +296,7 @@ def logB(alpha, beta):
    The logarithm of the normalisation factor that appears when doing
    Bayesian fitting of binomial functions.
    """
-   return sp.loggamma(alpha) + sp.loggamma(beta) - sp.loggamma(alpha + beta)
+   return sp.betaln(alpha, beta)
 
 class IDMismatchError(Exception):
    """
@@ -785,16 +809,20 @@ class simulated_participant(participant):
       self.digicomp_set = True
       return
    
-   def calculate_results(self, n_sessions, n_skills):
+   def calculate_results(self, n_sessions, n_skills, rng = None):
       """
       Simulate results of a learning module. This requires digital
-      competence to already have been set.
+      competence to already have been set. The random numbers are drawn
+      from rng if given, and otherwise from a generator shared by the
+      module.
       """
+      if rng is None:
+         rng = _rng
       if self.digicomp_set:
          self.n_sessions = n_sessions
          self.n_skills = n_skills
          self.results = np.zeros((n_sessions, n_skills), dtype = bool)
-         flat_random = rd.random((n_sessions, n_skills))
+         flat_random = rng.random((n_sessions, n_skills))
          digicomp_array = np.tile(np.linspace(self.digicomp_initial, self.digicomp_final, num = n_sessions), (n_skills, 1)).T
          self.results = flat_random < digicomp_array
          self.results_read = True
@@ -876,17 +904,19 @@ class learning_module(ABC):
 
       manipulation_flags = {}
       for i in range(n_manipulations):
-         flags = np.zeros(self.n_participants, dtype = np.bool)
+         flags = np.zeros(self.n_participants, dtype = bool)
          manipulation = self.manipulations[i]
 
          for subgroup_name, subgroup_indices in self.subgroups.items():
             n_blocks = 2**(i+1)
-            block_exact_breakpoints = np.linspace(0, len(subgroup_indices), 2**(i+1) + 1)
+            block_exact_breakpoints = np.linspace(0, len(subgroup_indices), n_blocks + 1)
             block_breakpoints = np.rint(block_exact_breakpoints).astype(int)
-         
-            for start, stop in zip(block_breakpoints[0:-2:2], block_breakpoints[1:-1:2]):
-               flags[subgroup_indices[start:stop]] = True
-            manipulation_flags[manipulation.name] = flags
+            # Every other block, starting with the first, gets the
+            # manipulation. Rather than looping over the blocks, look up
+            # which block each member of the subgroup falls in.
+            block = np.searchsorted(block_breakpoints, np.arange(len(subgroup_indices)), side = 'right') - 1
+            flags[subgroup_indices] = block % 2 == 0
+         manipulation_flags[manipulation.name] = flags
       return manipulation_flags
 
    def set_manipulations(self, manipulations):
@@ -1007,7 +1037,7 @@ class learning_module(ABC):
       
       for CBV in CBVs:
          try:
-            CBV_values[CBV.name] = np.asarray(_match_ids(self.ids, ids, CBV_values[CBV.name]), dtype = np.bool)
+            CBV_values[CBV.name] = np.asarray(_match_ids(self.ids, ids, CBV_values[CBV.name]), dtype = bool)
          except IDMismatchError:
             print("Cannot read data from file!")
             print("IDs in file do not match IDs of participants in study")
@@ -1039,7 +1069,7 @@ class learning_module(ABC):
       
       for BBV in known_BBVs + discovered_BBVs:
          try:
-            BBV_flags[BBV.name] = np.asarray(_match_ids(self.ids, ids, BBV_flags[BBV.name]), dtype = np.bool)
+            BBV_flags[BBV.name] = np.asarray(_match_ids(self.ids, ids, BBV_flags[BBV.name]), dtype = bool)
          except IDMismatchError:
             print("Cannot read data from file!")
             print("IDs in file do not match IDs of participants in study")
@@ -1071,7 +1101,7 @@ class learning_module(ABC):
       
       for manipulation in manipulations:
          try:
-            manipulation_flags[manipulation.name] = np.asarray(_match_ids(self.ids, ids, manipulation_flags[manipulation.name]), dtype = np.bool)
+            manipulation_flags[manipulation.name] = np.asarray(_match_ids(self.ids, ids, manipulation_flags[manipulation.name]), dtype = bool)
          except IDMismatchError:
             print("Cannot read data from file!")
             print("IDs in file do not match IDs of participants in study")
@@ -1148,8 +1178,11 @@ class simulated_learning_module(learning_module):
    \tTypically, this is done by a study object.
    digicomp_set : bool
    \tWhether anything has set digicomp_initial and digicomp_final
+   rng : numpy Generator
+   \tThe random number generator used for everything random in the
+   \tsimulation, except the values of the CBVs
    """
-   def __init__(self, n_skills, n_sessions, n_participants, default_digicomp, default_effect, known_BBVs = [], discovered_BBVs = [], unknown_BBVs = [], CBVs = [], boundaries = None):
+   def __init__(self, n_skills, n_sessions, n_participants, default_digicomp, default_effect, known_BBVs = [], discovered_BBVs = [], unknown_BBVs = [], CBVs = [], boundaries = None, seed = None):
       """
       Parameters
       ----------
@@ -1170,9 +1203,13 @@ class simulated_learning_module(learning_module):
       \tDescribed under attributes
       boundaries : boundaries
       \tDescribed under boundaries
+      seed : int
+      \tSeed for rng. If none is given, the simulation will be different
+      \teach time.
       """
       learning_module.__init__(self, n_skills, n_sessions, boundaries)
       self.n_participants = n_participants
+      self.rng = rd.default_rng(seed)
 
       self.ids = [str(number) for number in range(self.n_participants)]
       for ID in self.ids:
@@ -1186,8 +1223,11 @@ class simulated_learning_module(learning_module):
       self.BBVs = self.known_BBVs + self.discovered_BBVs + self.unknown_BBVs
       self.n_BBV = len(self.BBVs)
       self.BBV_flags = {}
-      for BBV in self.BBVs:
-         self.BBV_flags[BBV.name] = rd.random(self.n_participants) < BBV.fraction
+      # The flags for all BBVs are drawn at once, one row per BBV
+      fractions = np.asarray([BBV.fraction for BBV in self.BBVs], dtype = np.float64)
+      all_BBV_flags = self.rng.random((self.n_BBV, self.n_participants)) < fractions[:,np.newaxis]
+      for BBV, flags in zip(self.BBVs, all_BBV_flags):
+         self.BBV_flags[BBV.name] = flags
       
       self.CBVs = CBVs
       self.CBV_values = {}
@@ -1202,7 +1242,7 @@ class simulated_learning_module(learning_module):
 
       # This cannot be calculated without a study object that specifies the
       # default effect of the learning modules and any manipulations
-      self.digicomp_final = np.nan * np.zeros(self.n_participants)
+      self.digicomp_final = np.full(self.n_participants, np.nan)
       return
    
    ### Methods for calculating digital competence
@@ -1242,7 +1282,7 @@ class simulated_learning_module(learning_module):
       for i in range(self.n_participants):
          participant, digicomp_initial, digicomp_final = self.participants[i], self.digicomp_initial[i], self.digicomp_final[i]
          participant.set_digicomp(digicomp_initial, digicomp_final)
-         participant.calculate_results(self.n_sessions, self.n_skills)
+         participant.calculate_results(self.n_sessions, self.n_skills, rng = self.rng)
          self.results[:,i] = participant.correct_onwards
       self.results_initial = self.results[0,:]
       self.results_final = self.results[self.n_sessions - 1,:]
@@ -1285,7 +1325,7 @@ class simulated_learning_module(learning_module):
             for wording, BBV_list in [("discovered", self.discovered_BBVs), ("unknown", self.unknown_BBVs)]:
                print("{}Out of these, some may be affected by {} BBVs:".format(_indent(2), wording))
                for BBV in BBV_list:
-                  print("{}{}: {}".format(_indent(3), BBV.name, sum(self.BBV_flags[BBV.name][subgroup_members])))
+                  print("{}{}: {}".format(_indent(3), BBV.name, np.sum(self.BBV_flags[BBV.name][subgroup_members])))
       if self.n_CBV > 0:
          print("\nThere {} {} CBV{}".format(_is_are(self.n_CBV), self.n_CBV, _plural_ending(self.n_CBV)))
          for CBV in self.CBVs:
@@ -1374,9 +1414,8 @@ class study:
       # versions of the course
       self._qk_samples = self.learning_module.n_participants * 10
       self._qk_sample_width = 1 / self._qk_samples
-      self._Qki_range = np.linspace(0.0, 1.0, num=self._qk_samples)
       self._dk_samples = 2 * self._qk_samples - 1
-      self._Dk_range = np.linspace(-1.0, 1.0, num=self._dk_samples)
+      self._Qki_range, self._Dk_range = _quality_ranges(self._qk_samples)
       return
       
 
@@ -1410,7 +1449,7 @@ class study:
       percentiles = [0.13, 2.28, 15.87, 25.0, 50.0, 75.0, 84.13, 97.72, 99.87]
       n_percentiles = len(percentiles)
       percentile_indices = range(n_percentiles)
-      percentile_passed = np.zeros(n_percentiles, np.bool)
+      percentile_passed = np.zeros(n_percentiles, dtype = bool)
       
       CDF = 0
       percentile_dict = {}
@@ -1435,7 +1474,7 @@ class study:
          return
 
       qki_mass = qki * self._qk_sample_width
-      total_mass = sum(qki_mass)
+      total_mass = np.sum(qki_mass)
       if np.abs(total_mass - 1) > 0.01:
          print("Problem in calculation!")
          print("probability density function not well normalised")
@@ -1483,17 +1522,9 @@ class study:
       have high digital competence after the course module. This requires
       definition of bounds for low and high quality when creating the study.
       """
-      with np.errstate(all = 'ignore'):
-         log_qki = np.zeros(len(Qki))
-         log_qki[1:-1] = nlh * np.log(Qki[1:-1]) + (nl - nlh) * np.log(1 - Qki[1:-1]) - logB(nlh + 1, nl - nlh + 1)
-         if nlh > 0:
-            log_qki[0] = - np.inf
-         else:
-            log_qki[0] = - logB(nlh + 1, nl - nlh + 1)
-         if nl - nlh > 0:
-            log_qki[-1] = - np.inf
-         else:
-            log_qki[-1] = - logB(nlh + 1, nl - nlh + 1)
+      # xlogy and xlog1py treat 0 * log(0) as 0, so the end points Qki = 0
+      # and Qki = 1 come out right without special treatment
+      log_qki = sp.xlogy(nlh, Qki) + sp.xlog1py(nl - nlh, - Qki) - logB(nlh + 1, nl - nlh + 1)
       return log_qki
       
    def _boundary_tests(self, pre, post):
@@ -1548,17 +1579,7 @@ class study:
    ### Functions specific to the Bayesian median tests
       
    def _logL_median(self, Qki, nki, n_good):
-      with np.errstate(all = 'ignore'):
-         log_qki = np.zeros(len(Qki))
-         log_qki[1:-1] = n_good * np.log(Qki[1:-1]) + (nki - n_good) * np.log(1 - Qki[1:-1]) - logB(n_good + 1, nki - n_good + 1)
-         if n_good > 0:
-            log_qki[0] = - np.inf
-         else:
-            log_qki[0] = - logB(n_good + 1, nki - n_good + 1)
-         if nki - n_good > 0:
-            log_qki[-1] = - np.inf
-         else:
-            log_qki[-1] = - logB(n_good + 1, nki - n_good + 1)
+      log_qki = sp.xlogy(n_good, Qki) + sp.xlog1py(nki - n_good, - Qki) - logB(n_good + 1, nki - n_good + 1)
       return log_qki
       
    def _median_tests(self, control, treat):